@@ -0,0 +1,600 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+"""benchmark of the remote interactions of the jpl and jenkins extensions
+
+A local stand-in of the CubicWeb forge (RQL view and rqlio) and of the
+Jenkins JSON API is started, answering queries from a synthetic dataset
+after a configurable latency. A synthetic repository is built with public
+changesets, draft changesets and obsoleted precursors of drafts, then
+commands of both extensions are timed against it, counting requests sent
+to the stand-in servers.
+
+Results are stored as JSON, by default in `bench/results/<revision>.json`,
+and can be compared with an earlier run::
+
+  bench/hgbench.py --drafts 5000 --latency 50
+  bench/hgbench.py --compare bench/results/1a2b3c4d5e6f.json
+
+The jpl extension requires a Python 2 Mercurial with the evolve extension
+while the jenkins one requires a Python 3 Mercurial; use `--hg` and
+`--hg-jenkins` to give their executables, and `-k` to only run some of the
+scenarios.
+"""
+from __future__ import print_function
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RESULTS = os.path.join(HERE, 'results')
+
+PATCH_STATES = ('in-progress', 'pending-review', 'reviewed', 'applied')
+TASK_STATES = ('todo', 'done')
+BUILD_RESULTS = ('SUCCESS', 'FAILURE', 'SUCCESS', 'UNSTABLE')
+COMMITTER = 'bench'
+
+# extension creating obsolescence markers in bulk, `hg debugobsolete`
+# taking one marker per call
+OBSEXT = '''
+from mercurial import obsolete
+try:
+    from mercurial import registrar
+    cmdtable = {}
+    command = registrar.command(cmdtable)
+except (ImportError, AttributeError):
+    from mercurial import cmdutil
+    cmdtable = {}
+    command = cmdutil.command(cmdtable)
+
+
+@command(b'debugbenchobsolete', [], b'OLDREV NEWREV COUNT')
+def debugbenchobsolete(ui, repo, old, new, count):
+    """obsolete COUNT revisions from OLDREV by those from NEWREV"""
+    old, new = int(old), int(new)
+    relations = [(repo[old + i], (repo[new + i],))
+                 for i in range(int(count))]
+    lock = repo.lock()
+    try:
+        tr = repo.transaction(b'bench')
+        try:
+            obsolete.createmarkers(repo, relations)
+            tr.close()
+        finally:
+            tr.release()
+    finally:
+        lock.release()
+'''
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Dataset(object):
+    """Synthetic forge and Jenkins data about given changesets.
+
+    Changesets (full hex) are grouped by `patchsize` into patches, each
+    patch having `tasks` tasks; Jenkins jobs have one build per changeset,
+    the last `building` ones being still running.
+    """
+
+    def __init__(self, nodes, precursors, patchsize=3, tasks=2, jobs=2,
+                 building=5):
+        self.nodes = nodes
+        self.patches = {}
+        self.patchof = {}
+        for idx, node in enumerate(nodes):
+            eid = 1000 + idx // patchsize
+            patch = self.patches.setdefault(eid, {
+                'eid': eid,
+                'name': 'patch %d' % eid,
+                'state': PATCH_STATES[eid % len(PATCH_STATES)],
+                'committer': COMMITTER if eid % 2 else 'someone',
+                'reviewers': 'alice, bob' if eid % 3 else '',
+                'csets': [],
+                'tasks': [(eid * 10 + t, 'task %d of patch %d' % (t, eid),
+                           TASK_STATES[(eid + t) % len(TASK_STATES)])
+                          for t in range(tasks)],
+            })
+            patch['csets'].append(node[:12])
+            self.patchof[node[:12]] = patch
+        # precursors belong to the patch of their successor
+        for prec, succ in precursors:
+            patch = self.patchof.get(succ[:12])
+            if patch is not None:
+                patch['csets'].append(prec[:12])
+                self.patchof[prec[:12]] = patch
+        self.jobs = {}
+        for job in range(jobs):
+            builds = []
+            for number, node in enumerate(nodes, 1):
+                running = number > len(nodes) - building
+                builds.append({
+                    'number': number,
+                    'building': running,
+                    'result': None if running else
+                    BUILD_RESULTS[(number + job) % len(BUILD_RESULTS)],
+                    'actions': [{}, {'mercurialNodeName': node}],
+                })
+            # most recent first, like Jenkins
+            builds.reverse()
+            self.jobs['job%d' % job] = builds
+
+
+class Counter(object):
+    """Requests and bytes sent by a stand-in server"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def add(self, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+
+
+class StandInHandler(BaseHTTPRequestHandler, object):
+    dataset = None
+    counter = None
+    latency = 0.
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data, code=200):
+        body = json.dumps(data).encode('utf-8')
+        time.sleep(self.latency)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.counter.add(len(body))
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+CSETS_RE = re.compile(r"changeset\s+(?:IN\s*\()?((?:\s*'[0-9a-f]+'\s*,?)+)")
+STATES_RE = re.compile(r'S name (?:IN \(([^)]*)\)|("[^"]*")|!= "done")')
+
+
+class ForgeHandler(StandInHandler):
+    """stand-in of the RQL view and rqlio API of a CubicWeb forge"""
+
+    def do_POST(self):
+        path = urlparse(self.path).path.strip('/')
+        body = self.body()
+        if path == 'view':
+            form = parse_qs(body.decode('utf-8'))
+            rql = form['rql'][0]
+            if rql.startswith('rql:'):
+                rql = rql[4:]
+            self.reply(self.query(rql, {}))
+        elif path.startswith('rqlio'):
+            queries = self.multipartjson(body)
+            self.reply([self.query(rql, args or {}) for rql, args in queries])
+        else:
+            self.reply({'reason': 'not found'}, 404)
+
+    def multipartjson(self, body):
+        ctype = self.headers.get('Content-Type')
+        boundary = ctype.split('boundary=')[1].encode('ascii')
+        for part in body.split(b'--' + boundary):
+            head, _, content = part.partition(b'\r\n\r\n')
+            if b'name="json"' in head:
+                return json.loads(content.rstrip(b'\r\n').decode('utf-8'))
+        return []
+
+    def csets(self, rql, args):
+        match = CSETS_RE.search(rql)
+        if match:
+            return re.findall(r"'([0-9a-f]+)'", match.group(1))
+        for key in ('cset', 'changeset', 'cs'):
+            if key in args:
+                return [args[key]]
+        return None
+
+    def patches(self, csets):
+        if csets is None:
+            return list(self.dataset.patches.values())
+        patches = []
+        for cset in csets:
+            patch = self.dataset.patchof.get(cset)
+            if patch is not None and patch not in patches:
+                patches.append(patch)
+        return patches
+
+    def query(self, rql, args):
+        rql = ' '.join(rql.split())
+        csets = self.csets(rql, args)
+        if rql.startswith(('SET ', 'INSERT ', 'DELETE ')):
+            return []
+        if rql.startswith('Any PO, RC, P'):
+            # reviewed()
+            return [[1, cset, patch['eid']]
+                    for patch in self.patches(csets)
+                    if patch['state'] == 'reviewed'
+                    for cset in patch['csets']
+                    if csets is None or cset in csets]
+        if rql.startswith('Any R WHERE R changeset'):
+            # root of the repository, known to the forge
+            return [[1]]
+        if rql.startswith('Any PO, RC, T'):
+            # inversion()
+            return [[1, cset, patch['eid'] + 100000]
+                    for patch in self.patches(csets) if patch['eid'] % 4 == 0
+                    for cset in patch['csets']]
+        if rql.startswith('DISTINCT Any RC'):
+            # tasks()
+            match = STATES_RE.search(rql)
+            states = (re.findall(r'"([^"]*)"', match.group(1) or
+                                 match.group(2) or '')
+                      if match else ())
+            return [[cset] for patch in self.patches(csets)
+                    if any(state in states if states else state != 'done'
+                           for _, _, state in patch['tasks'])
+                    for cset in patch['csets']]
+        if rql.startswith('DISTINCT Any P,PN,SN,R,T'):
+            # tasks command and {tasks} keyword
+            showdone = 'NULL' in rql
+            rows = []
+            for cset in csets or ():
+                patch = self.dataset.patchof.get(cset)
+                if patch is None:
+                    continue
+                head = [patch['eid'], patch['name'], patch['state'],
+                        patch['eid'] * 100 + patch['csets'].index(cset)]
+                tasks = [task for task in patch['tasks']
+                         if showdone or task[2] != 'done']
+                for teid, title, state in tasks:
+                    rows.append(head + [teid, title, None, state, cset])
+                if not tasks and showdone:
+                    rows.append(head + [None] * 4 + [cset])
+            return rows
+        if rql.startswith('Any PN, P, GROUP_CONCAT(CSET)'):
+            # show-review and backlog
+            rows = []
+            for patch in self.patches(csets):
+                if ('patch_committer' in rql
+                        and patch['committer'] != COMMITTER):
+                    continue
+                rows.append([patch['name'], patch['eid'],
+                             ', '.join(c for c in patch['csets']
+                                       if csets is None or c in csets),
+                             patch['state'], patch['reviewers']])
+            return rows
+        if rql.startswith('Any PEN, TCN, ST'):
+            return [['env', 'config%d' % i, BUILD_RESULTS[i]]
+                    for i in range(2)]
+        if rql.startswith('Any TCN, TCL'):
+            return [['config%d' % i, 'Config %d' % i] for i in range(2)]
+        if rql.startswith('Any P WHERE'):
+            # ask-review and acknowledge
+            return [[patch['eid']] for patch in self.patches(csets or [])]
+        return []
+
+
+class JenkinsHandler(StandInHandler):
+    """stand-in of the JSON API of a Jenkins server"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] != 'job' or parts[-1] != 'json':
+            # e.g. crumb issuer
+            return self.reply({}, 404)
+        builds = self.dataset.jobs.get(parts[1])
+        if builds is None:
+            return self.reply({}, 404)
+        query = parse_qs(url.query)
+        if len(parts) == 5:
+            # api of a build
+            number = int(parts[2])
+            for build in builds:
+                if build['number'] == number:
+                    return self.reply(self.build(parts[1], build))
+            return self.reply({}, 404)
+        tree = query.get('tree', [''])[0]
+        match = re.search(r'\{(\d+),(\d+)\}', tree)
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            return self.reply({'allBuilds': [self.build(parts[1], build)
+                                             for build in builds[start:end]]})
+        return self.reply({
+            'name': parts[1],
+            'builds': [{'number': build['number'],
+                        'url': self.buildurl(parts[1], build)}
+                       for build in builds],
+        })
+
+    def buildurl(self, job, build):
+        return 'http://%s:%d/job/%s/%d/' % (self.server.server_address[0],
+                                            self.server.server_address[1],
+                                            job, build['number'])
+
+    def build(self, job, build):
+        return dict(build, url=self.buildurl(job, build))
+
+
+def serve(handler, dataset, latency):
+    """Start a stand-in server in a thread, return (url, counter)"""
+    counter = Counter()
+    handler = type(handler.__name__, (handler,), {
+        'dataset': dataset, 'counter': counter, 'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/' % server.server_address[1], counter
+
+
+def hg(hgexe, repo, args, env, stdout=None):
+    cmd = [hgexe, '-R', repo] + args
+    return subprocess.check_output(cmd, env=env) if stdout is None else \
+        subprocess.check_call(cmd, env=env, stdout=stdout)
+
+
+def buildrepo(hgexe, path, env, public, drafts, precursors):
+    """Build a repository of `public` public changesets followed by `drafts`
+    draft changesets, the first `precursors` of them having an obsolete
+    precursor. Return (draft nodes, [(precursor, successor)])."""
+    precursors = min(precursors, drafts)
+    subprocess.check_call([hgexe, 'init', path], env=env)
+    dag = '+%d :base +%d' % (public, drafts)
+    if precursors:
+        dag += ' <base +%d' % precursors
+    hg(hgexe, path, ['debugbuilddag', dag], env)
+    hg(hgexe, path, ['phase', '--public', '-r', str(public - 1)], env)
+    if precursors:
+        hg(hgexe, path, ['debugbenchobsolete', str(public + drafts),
+                         str(public), str(precursors)], env)
+    log = hg(hgexe, path, ['log', '--hidden', '-r', 'draft()',
+                           '-T', '{rev} {node}\\n'], env)
+    nodes = dict(line.split() for line in log.decode('ascii').splitlines())
+    nodes = dict((int(rev), node) for rev, node in nodes.items())
+    draftnodes = [nodes[rev] for rev in range(public, public + drafts)]
+    pairs = [(nodes[public + drafts + i], nodes[public + i])
+             for i in range(precursors)]
+    return draftnodes, pairs
+
+
+def writehgrc(path, lines):
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+SCENARIOS = [
+    # name, extension, hg arguments, command to prepare caches before the
+    # first run
+    ('tasks', 'jpl', ['tasks', '-r', 'draft()'], None),
+    ('tasks-all', 'jpl', ['tasks', '--all', '-r', 'draft()'], None),
+    ('show-review', 'jpl', ['show-review', '-r', 'draft()'], None),
+    ('show-review-tests', 'jpl',
+     ['show-review', '--test-results', '-r', 'last(draft(), 200)'], None),
+    ('backlog', 'jpl', ['backlog', '-c', COMMITTER], None),
+    ('log-tasks', 'jpl',
+     ['log', '-r', 'last(draft(), 200)', '-T', '{tasks}\\n'], None),
+    ('revset-reviewed', 'jpl',
+     ['log', '-r', 'reviewed()', '-T', '{node|short}\\n'], None),
+    ('revset-reviewed-drafts', 'jpl',
+     ['log', '-r', 'last(draft(), 200) and reviewed()',
+      '-T', '{node|short}\\n'], None),
+    ('revset-tasks', 'jpl',
+     ['log', '-r', 'tasks()', '-T', '{node|short}\\n'], None),
+    ('revset-inversion', 'jpl',
+     ['log', '-r', 'inversion(1.0)', '-T', '{node|short}\\n'], None),
+    ('show-jenkins', 'jenkins', ['show', 'jenkins'],
+     ['debugjenkins', '--clear']),
+    ('log-build-status', 'jenkins',
+     ['log', '-r', 'draft()', '-T', '{build_status}\\n'],
+     ['debugjenkins', '--clear']),
+    # the revset reads the store without refreshing it
+    ('revset-jenkins', 'jenkins',
+     ['log', '-r', 'draft() and jenkins(job0, FAILURE)',
+      '-T', '{node|short}\\n'], ['debugjenkins', '--refresh']),
+]
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.
+
+
+def runscenario(hgexe, repo, env, args, clear, counter, repeat):
+    """Run `hg args` `repeat` times, the first run after `hg clear`;
+    return the result of the scenario"""
+    if clear:
+        hg(hgexe, repo, clear, env)
+    runs = []
+    requests = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            counter.reset()
+            start = time.time()
+            hg(hgexe, repo, args, env, stdout=devnull)
+            runs.append(time.time() - start)
+            requests.append((counter.requests, counter.bytes))
+    return {
+        'runs': runs,
+        'first': runs[0],
+        'min': min(runs),
+        'median': median(runs),
+        'requests': requests[0][0],
+        'bytes': requests[0][1],
+        'requests-next': requests[-1][0],
+    }
+
+
+def revision():
+    """Return the revision of the extensions being benchmarked"""
+    for cmd in (['hg', 'id', '-i', '-R', ROOT],
+                ['git', '-C', ROOT, 'rev-parse', '--short=12', 'HEAD']):
+        try:
+            with open(os.devnull, 'w') as devnull:
+                out = subprocess.check_output(cmd, stderr=devnull)
+            return out.decode('ascii').strip()
+        except (OSError, subprocess.CalledProcessError):
+            continue
+    return 'unknown'
+
+
+def printresults(results, reference=None):
+    print('%-24s %9s %9s %9s %9s %11s' % ('scenario', 'first', 'min',
+                                          'median', 'requests', 'bytes'))
+    for name, result in sorted(results.items()):
+        line = '%-24s %9.3f %9.3f %9.3f %9d %11d' % (
+            name, result['first'], result['min'], result['median'],
+            result['requests'], result['bytes'])
+        ref = (reference or {}).get(name)
+        if ref and ref['median']:
+            line += '  %+6.1f%% (%d requests)' % (
+                (result['median'] / ref['median'] - 1) * 100,
+                ref['requests'])
+        print(line)
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options]', description=__doc__)
+    parser.add_option('--hg', default='hg',
+                      help='Mercurial executable to run jpl commands')
+    parser.add_option('--hg-jenkins', default=None,
+                      help='Mercurial executable to run jenkins commands '
+                      '(defaults to --hg)')
+    parser.add_option('--public', type='int', default=1000,
+                      help='number of public changesets')
+    parser.add_option('--drafts', type='int', default=2000,
+                      help='number of draft changesets')
+    parser.add_option('--precursors', type='int', default=500,
+                      help='number of drafts having an obsolete precursor')
+    parser.add_option('--tasks', type='int', default=2,
+                      help='number of tasks per patch')
+    parser.add_option('--jobs', type='int', default=2,
+                      help='number of Jenkins jobs')
+    parser.add_option('--latency', type='float', default=20.,
+                      help='latency of stand-in servers, in milliseconds')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='number of runs of each scenario')
+    parser.add_option('-k', dest='pattern', default=None,
+                      help='only run scenarios whose name matches PATTERN')
+    parser.add_option('-o', '--output', default=None,
+                      help='where to store results (defaults to '
+                      'bench/results/<revision>.json)')
+    parser.add_option('--compare', default=None,
+                      help='results of an earlier run to compare with')
+    opts, args = parser.parse_args(argv)
+    hgjenkins = opts.hg_jenkins or opts.hg
+
+    tmpdir = tempfile.mkdtemp(prefix='hgbench-')
+    try:
+        env = dict(os.environ)
+        obsext = os.path.join(tmpdir, 'benchobs.py')
+        with open(obsext, 'w') as f:
+            f.write(OBSEXT)
+        env['HGRCPATH'] = writehgrc(os.path.join(tmpdir, 'build.hgrc'), [
+            '[extensions]', 'benchobs = %s' % obsext,
+            '[experimental]', 'evolution = all',
+            '[ui]', 'username = bench <bench@example.org>'])
+        repo = os.path.join(tmpdir, 'repo')
+        print('building repository of %d public and %d draft changesets...'
+              % (opts.public, opts.drafts))
+        nodes, precursors = buildrepo(opts.hg, repo, env, opts.public,
+                                      opts.drafts, opts.precursors)
+        dataset = Dataset(nodes, precursors, tasks=opts.tasks,
+                          jobs=opts.jobs)
+        latency = opts.latency / 1000.
+        forgeurl, forgecounter = serve(ForgeHandler, dataset, latency)
+        jenkinsurl, jenkinscounter = serve(JenkinsHandler, dataset, latency)
+        # cwclientlib only connects to endpoints of its configuration
+        cwclconf = os.path.join(tmpdir, 'cwclientlibrc.json')
+        with open(cwclconf, 'w') as f:
+            json.dump({'bench': {'url': forgeurl, 'token-id': 'bench',
+                                 'secret': 'bench'}}, f)
+        os.chmod(cwclconf, 0o600)
+        common = ['[experimental]', 'evolution = all',
+                  '[ui]', 'username = bench <bench@example.org>']
+        jplrc = writehgrc(os.path.join(tmpdir, 'jpl.hgrc'), common + [
+            # the tasks command requires evolve revsets
+            '[extensions]', 'evolve =',
+            'jpl = %s' % os.path.join(ROOT, 'hgext', 'jpl'),
+            '[jpl]', 'endpoint = bench', 'cache-ttl = 0'])
+        jenkinsrc = writehgrc(os.path.join(tmpdir, 'jenkins.hgrc'), common + [
+            '[extensions]', 'show =',
+            'jenkins = %s' % os.path.join(ROOT, 'hgext', 'jenkins.py'),
+            '[jenkins]', 'url = %s' % jenkinsurl,
+            'job = %s' % ','.join(sorted(dataset.jobs))])
+        setups = {
+            'jpl': (opts.hg, forgecounter,
+                    dict(env, CWCLCONF=cwclconf, HGRCPATH=jplrc)),
+            'jenkins': (hgjenkins, jenkinscounter,
+                        dict(env, HGRCPATH=jenkinsrc)),
+        }
+
+        results = {}
+        for name, ext, hgargs, clear in SCENARIOS:
+            if opts.pattern and not re.search(opts.pattern, name):
+                continue
+            hgexe, counter, runenv = setups[ext]
+            print('running %s...' % name)
+            try:
+                results[name] = runscenario(hgexe, repo, runenv, hgargs,
+                                            clear, counter, opts.repeat)
+            except subprocess.CalledProcessError as exc:
+                print('  failed: %s' % exc)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    params = dict((key, getattr(opts, key)) for key in (
+        'public', 'drafts', 'precursors', 'tasks', 'jobs', 'latency',
+        'repeat'))
+    rev = revision()
+    output = opts.output or os.path.join(RESULTS, '%s.json' % rev)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump({'revision': rev, 'date': time.time(), 'params': params,
+                   'results': results}, f, indent=1, sort_keys=True)
+
+    reference = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            reference = json.load(f)
+        if reference['params'] != params:
+            print('warning: compared results were obtained with other '
+                  'parameters: %s' % reference['params'])
+        reference = reference['results']
+    printresults(results, reference)
+    print('results stored in %s' % output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
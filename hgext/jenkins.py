@@ -3,8 +3,11 @@
 This extension provides:
 
 * a "build_status" template keyword
+* a "jenkins(job[, status])" revset predicate, reading the store of
+  Jenkins builds without contacting Jenkins
 * a "jenkins" view for `hg show` command (requires the built-in "show"
-  extension)
+  extension); `hg show jenkins --watch` keeps updating it while builds are
+  running
 
 Information to access the Jenkins server and job needs to be defined in a
 "jenkins" configuration section::
@@ -12,64 +15,186 @@ Information to access the Jenkins server and job needs to be defined in a
   [jenkins]
   url = <URL of Jenkins server>
   job = <name of the job>,<name of another job>
+  # number of builds fetched per request (default 100)
+  page-size = 100
+  # timeout in seconds of Jenkins requests and of the refresh of a job
+  timeout = 30
+  # number of jobs fetched concurrently
+  workers = 4
+  # "json" (default) or "binary", a compact memory-mapped format better
+  # suited to long build histories
+  store-format = json
+  # refresh the store in a background process after pull and commit,
+  # instead of when displaying build status
+  background-refresh = no
+  # seconds between two polls of running builds with `hg show jenkins
+  # --watch`, doubled (up to watch-max-interval) while nothing changes
+  watch-interval = 10
+  watch-max-interval = 300
+  # report requests sent to Jenkins (latency, size) and lookups in the
+  # store when the command ends, or write them as JSON to trace-file
+  trace = no
+  trace-file = /tmp/jenkins-trace.json
 
   [auth]
   jenkins.schemes = https
   jenkins.prefix = jenkins.logilab.org
   jenkins.username = <Jenkins user ID>
   jenkins.password = <respective Jenkins user API token>
+
+The store of Jenkins builds can be refreshed with `hg debugjenkins --refresh`.
 """
 from __future__ import absolute_import
 
+import binascii
 from collections import defaultdict
 import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # Python 2
+    from collections import Mapping
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
 
+import requests
 from jenkins import (
     Jenkins,
+    JenkinsException,
     NotFoundException,
 )
 from mercurial import (
+    encoding,
     httpconnection as httpconnectionmod,
+    lock as lockmod,
     templatekw,
     error,
+    extensions,
+    pycompat,
     registrar,
+    revsetlang,
+    smartset,
     util,
 )
+try:
+    from mercurial.utils import procutil
+except ImportError:
+    # Mercurial < 4.6
+    procutil = util
+
+try:
+    from hgext.remotetrace import RemoteTrace
+except ImportError:
+    # extension loaded from a source tree rather than installed: load the
+    # module the way Mercurial loads extensions given by path
+    RemoteTrace = extensions.loadpath(
+        pycompat.fsencode(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'remotetrace.py')),
+        b'hgext.remotetrace').RemoteTrace
 
 
 cmdtable = {}
 command = registrar.command(cmdtable)
+revsetpredicate = registrar.revsetpredicate()
 
 
 @command(b'debugjenkins', [
     (b'', b'clear', None, b'clear Jenkins store'),
+    (b'', b'refresh', None, b'fetch new builds into Jenkins store'),
 ])
 def debugjenkins(ui, repo, **opts):
     """debug actions for 'jenkins' extension."""
     if opts.get(r'clear'):
         jenkinsstore(repo.svfs, None).clear()
+    elif opts.get(r'refresh'):
+        refreshstore(ui, repo)
     else:
         ui.warn(b'no option specified, did nothing\n')
 
 
-def buildinfo_for_job(jenkins_server, job_name):
-    # We retrieve all builds matching a hg-node.
-    build_for_hgnode = defaultdict(list)
+# All builds of a job with only the fields we need, by pages of builds
+# (allBuilds{start,end} range).
+JOB_BUILDS = (
+    '%(folder_url)sjob/%(short_name)s/api/json?tree=allBuilds['
+    'number,result,building,url,actions[mercurialNodeName]]'
+    '{%(start)d,%(end)d}'
+)
+PAGESIZE = 100
+# timeout (in seconds) of Jenkins requests and of the refresh of a job
+TIMEOUT = 30
+# number of jobs refreshed concurrently
+WORKERS = 4
+# seconds between two polls of running builds in watch mode
+WATCH_INTERVAL = 10
+WATCH_MAX_INTERVAL = 300
+
+
+def _iterbuilds_tree(jenkins_server, job_name, pagesize=PAGESIZE, since=0):
+    """Yield builds of a job more recent than build number `since`, fetched
+    with one "tree" request per page of `pagesize` builds"""
+    folder_url, short_name = jenkins_server._get_job_folder(job_name)
+    start = 0
+    while True:
+        url = jenkins_server._build_url(JOB_BUILDS, {
+            'folder_url': folder_url,
+            'short_name': short_name,
+            'start': start,
+            'end': start + pagesize,
+        })
+        response = jenkins_server.jenkins_open(requests.Request('GET', url))
+        builds = json.loads(response)['allBuilds']
+        # builds come most recent first
+        for build in builds:
+            if build['number'] <= since:
+                return
+            yield build
+        if len(builds) < pagesize:
+            break
+        start += pagesize
+
+
+def _iterbuilds_perbuild(jenkins_server, job_name, since=0):
+    """Yield builds of a job more recent than build number `since`, fetched
+    with one request per build"""
+    jobinfo = jenkins_server.get_job_info(job_name)
+    for build in jobinfo['builds']:
+        if build['number'] > since:
+            yield jenkins_server.get_build_info(job_name, build['number'])
+
+
+def _fetchbuilds(jenkins_server, job_name, pagesize=PAGESIZE, since=0):
+    """Return builds of a job more recent than build number `since`"""
     try:
-        jobinfo = jenkins_server.get_job_info(job_name)
+        return list(_iterbuilds_tree(jenkins_server, job_name, pagesize,
+                                     since))
     except NotFoundException:
         raise error.ConfigError(
             "job '%s' not found" % job_name,
             hint='see if jenkins.job config entry is correct',
         )
-    for build in jobinfo['builds']:
-        build_number = build['number']
-        build_info = jenkins_server.get_build_info(job_name, build_number)
+    except (JenkinsException, ValueError, KeyError):
+        # "tree" queries not supported, fall back to one request per build
+        return list(_iterbuilds_perbuild(jenkins_server, job_name, since))
+
+
+def _indexbuilds(builds):
+    """Return the latest build of `builds` for each hg-node"""
+    build_for_hgnode = defaultdict(list)
+    for build_info in builds:
         for action in build_info['actions']:
-            hgnode = action.get('mercurialNodeName')
+            hgnode = (action or {}).get('mercurialNodeName')
             if hgnode:
                 build_for_hgnode[hgnode].append({
-                    'number': build_number,
+                    'number': build_info['number'],
                     'status': build_info['result'],
                     'building': build_info['building'],
                     'url': build_info['url'],
@@ -83,61 +208,376 @@ def buildinfo_for_job(jenkins_server, job_name):
     return build_for_hgnode
 
 
+def buildinfo_for_job(jenkins_server, job_name, pagesize=PAGESIZE):
+    # We retrieve all builds matching a hg-node.
+    return _indexbuilds(_fetchbuilds(jenkins_server, job_name, pagesize))
+
+
+def refresh_buildinfo_for_job(jenkins_server, job_name, jobcache,
+                              lastbuild=0, pagesize=PAGESIZE):
+    """Update `jobcache` (hg-node index of a job) with builds more recent
+    than build number `lastbuild` and with the current state of indexed
+    builds that were still running.
+
+    Return the largest build number seen.
+    """
+    builds = _fetchbuilds(jenkins_server, job_name, pagesize, lastbuild)
+    for hgnode, info in _indexbuilds(builds).items():
+        if (hgnode not in jobcache
+                or jobcache[hgnode]['number'] < info['number']):
+            jobcache[hgnode] = info
+    for info in jobcache.values():
+        if info['building'] and info['number'] <= lastbuild:
+            build_info = jenkins_server.get_build_info(job_name,
+                                                       info['number'])
+            info['status'] = build_info['result']
+            info['building'] = build_info['building']
+    return max([lastbuild] + [build['number'] for build in builds])
+
+
+def hasbuilding(storecache):
+    """Return True if a build of the store is still running"""
+    return any(info['building']
+               for jobcache in storecache.get('jobs', {}).values()
+               for info in jobcache.values())
+
+
+def pollbuilding(ui, store, server):
+    """Fetch the current state of builds of `store` that were still
+    running, return True if one of them changed"""
+    storecache = store.cache
+    changed = False
+    for job, jobcache in storecache['jobs'].items():
+        building = [(hgnode, info) for hgnode, info in jobcache.items()
+                    if info['building']]
+        if not building:
+            continue
+        if not isinstance(jobcache, dict):
+            # binary store indexes are read-only
+            jobcache = storecache['jobs'][job] = {
+                hgnode: dict(info) for hgnode, info in jobcache.items()}
+        for hgnode, info in building:
+            try:
+                build_info = server.get_build_info(job, info['number'])
+            except (JenkinsException, requests.RequestException) as exc:
+                ui.warn(b'cannot fetch build %d of job %s: %s\n'
+                        % (info['number'], job.encode('utf-8'),
+                           str(exc).encode('utf-8')))
+                continue
+            if (build_info['building'], build_info['result']) != (
+                    info['building'], info['status']):
+                jobcache[hgnode] = dict(info, status=build_info['result'],
+                                        building=build_info['building'])
+                changed = True
+    if changed:
+        store.invalidate()
+    return changed
+
+
+# Binary store format: a header, a table of interned strings (job names,
+# build statuses and build url prefixes), a table of jobs and, for each job,
+# fixed-width build records sorted by binary hg-node.
+BINSTORE_MAGIC = b'HGJK'
+BINSTORE_VERSION = 1
+_binheader = struct.Struct('>4sBiII')  # magic, version, tip, strings, jobs
+_binstring = struct.Struct('>H')  # length of utf-8 string that follows
+_binjob = struct.Struct('>IIII')  # name, lastbuild, records count, offset
+# node, number, status, url, building, url kind
+_binrecord = struct.Struct('>20sIIIBBxx')
+NOSTATUS = 0xffffffff
+URL_PREFIX, URL_FULL = 0, 1  # url is "<prefix><number>/" or a full string
+
+
+class nodeindex(Mapping):
+    """Read-only {hex hg-node: build info} mapping of a job, looked up by
+    binary search in build records of a binary store"""
+
+    def __init__(self, data, offset, count, strings):
+        self._data = data
+        self._offset = offset
+        self._count = count
+        self._strings = strings
+
+    def _node(self, idx):
+        start = self._offset + idx * _binrecord.size
+        return self._data[start:start + 20]
+
+    def _find(self, node):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._node(mid) < node:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._node(lo) == node:
+            return lo
+        return None
+
+    def __getitem__(self, hexnode):
+        try:
+            node = binascii.unhexlify(hexnode)
+        except (TypeError, ValueError):
+            raise KeyError(hexnode)
+        idx = self._find(node)
+        if idx is None:
+            raise KeyError(hexnode)
+        _, number, status, url, building, urlkind = _binrecord.unpack_from(
+            self._data, self._offset + idx * _binrecord.size)
+        url = self._strings[url]
+        if urlkind == URL_PREFIX:
+            url = '{}{}/'.format(url, number)
+        return {
+            'number': number,
+            'status': None if status == NOSTATUS else self._strings[status],
+            'building': bool(building),
+            'url': url,
+        }
+
+    def __iter__(self):
+        for idx in range(self._count):
+            yield binascii.hexlify(self._node(idx)).decode('ascii')
+
+    def __len__(self):
+        return self._count
+
+
+def packbinstore(cache):
+    """Return the binary store format of `cache`"""
+    strings, stringidx = [], {}
+
+    def intern(string):
+        if string not in stringidx:
+            stringidx[string] = len(strings)
+            strings.append(string)
+        return stringidx[string]
+
+    jobs = []
+    for name, jobcache in sorted(cache.get('jobs', {}).items()):
+        records = []
+        for hexnode, info in jobcache.items():
+            url, suffix = info['url'], '{}/'.format(info['number'])
+            if url.endswith(suffix):
+                urlkind, url = URL_PREFIX, intern(url[:-len(suffix)])
+            else:
+                urlkind, url = URL_FULL, intern(url)
+            if info['status'] is None:
+                status = NOSTATUS
+            else:
+                status = intern(info['status'])
+            records.append(_binrecord.pack(
+                binascii.unhexlify(hexnode), info['number'], status, url,
+                bool(info['building']), urlkind))
+        # records start with the node, so this sorts them by node
+        records.sort()
+        jobs.append((intern(name), cache['lastbuild'].get(name, 0), records))
+
+    chunks = [_binheader.pack(BINSTORE_MAGIC, BINSTORE_VERSION,
+                              cache['tip'], len(strings), len(jobs))]
+    for string in strings:
+        string = string.encode('utf-8')
+        chunks.append(_binstring.pack(len(string)) + string)
+    offset = sum(len(c) for c in chunks) + len(jobs) * _binjob.size
+    for name, lastbuild, records in jobs:
+        chunks.append(_binjob.pack(name, lastbuild, len(records), offset))
+        offset += len(records) * _binrecord.size
+    for name, lastbuild, records in jobs:
+        chunks.extend(records)
+    return b''.join(chunks)
+
+
+def unpackbinstore(data):
+    """Return a store cache from binary store `data` (typically a mmap),
+    job indexes being lazy `nodeindex` mappings over `data`"""
+    magic, version, tip, nstrings, njobs = _binheader.unpack_from(data, 0)
+    if magic != BINSTORE_MAGIC or version != BINSTORE_VERSION:
+        raise ValueError('unsupported "jenkins" binary store')
+    offset = _binheader.size
+    strings = []
+    for _ in range(nstrings):
+        length, = _binstring.unpack_from(data, offset)
+        offset += _binstring.size
+        strings.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    cache = {'tip': tip, 'lastbuild': {}, 'jobs': {}}
+    for _ in range(njobs):
+        name, lastbuild, count, recoffset = _binjob.unpack_from(data, offset)
+        offset += _binjob.size
+        name = strings[name]
+        cache['lastbuild'][name] = lastbuild
+        cache['jobs'][name] = nodeindex(data, recoffset, count, strings)
+    return cache
+
+
 class jenkinsstore(object):
     """file-system cache for Jenkins data.
 
-    The cache is invalidated (not used and thus rebuilt) when specified
-    `tiprev` is greater that stored one, typically after a pull.
+    The cache is flagged as `outdated` when specified `tiprev` is greater
+    that stored one, typically after a pull: jobs then need to be refreshed
+    with builds more recent than their `lastbuild`.
+
+    With `fmt` set to "binary", the cache is stored in a memory-mapped
+    binary file (see `packbinstore`) instead of a JSON file, so that looking
+    up a build does not require to read the whole store.
     """
 
-    def __init__(self, svfs, tiprev):
+    def __init__(self, svfs, tiprev, fmt=b'json'):
         self.svfs = svfs
-        self.cache = {'tip': tiprev}
+        self.fmt = fmt
+        self.cache = {'tip': tiprev, 'lastbuild': {}}
+        self.outdated = False
+        # jobs refreshed since the store has been loaded
+        self.refreshed = set()
+        # jobs that could not be refreshed
+        self.failed = set()
+        # (job, (job cache, last build), exception) of refreshed jobs, see
+        # `refreshjobs`
+        self.results = queue.Queue()
+        self.dirty = False
+        # {job: {status: set of hex hg-nodes}}, built when first needed,
+        # see `nodes`
+        self._bystatus = None
+
+    def _read(self):
+        if self.fmt != b'binary':
+            data = self.svfs.tryread(b'jenkins')
+            return json.loads(data.decode('utf-8')) if data else None
+        try:
+            fp = self.svfs(b'jenkins.bin', b'rb')
+        except IOError:
+            return None
+        with fp:
+            size = os.fstat(fp.fileno()).st_size
+            if not size:
+                return None
+            data = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            return unpackbinstore(data)
+        except (ValueError, struct.error):
+            return None
 
     def load(self, ui):
-        """Possibly load "jenkins" store cache if still valid (w.r.t. tiprev).
+        """Possibly load "jenkins" store cache, flagging it as outdated if
+        tiprev moved.
         """
-        data = self.svfs.tryread(b'jenkins')
+        data = self._read()
         if data:
-            data = json.loads(data.decode('utf-8'))
             try:
                 storedtiprev = data['tip']
             except KeyError:
                 pass
             else:
-                if storedtiprev >= self.cache['tip']:
-                    self.cache = data
-                else:
-                    ui.warn(b'rebuidling "jenkins" store\n')
+                if storedtiprev < self.cache['tip']:
+                    ui.debug(b'refreshing "jenkins" store\n')
+                    self.outdated = True
+                    self.dirty = True
+                    data['tip'] = self.cache['tip']
+                data.setdefault('lastbuild', {})
+                self.cache = data
         return self.cache
 
     def save(self):
-        with self.svfs(b'jenkins', b'wb') as f:
-            f.write(json.dumps(self.cache).encode('utf-8'))
+        if self.fmt == b'binary':
+            with self.svfs(b'jenkins.bin', b'wb', atomictemp=True) as f:
+                f.write(packbinstore(self.cache))
+        else:
+            with self.svfs(b'jenkins', b'wb', atomictemp=True) as f:
+                f.write(json.dumps(self.cache).encode('utf-8'))
+        self.dirty = False
+
+    def storeresult(self, job, result, exc=None):
+        """Store the (job cache, last build) `result` of the refresh of
+        `job`, or flag it as failed if `exc` is set"""
+        if exc is not None:
+            self.failed.add(job)
+            return
+        self.cache['jobs'][job], self.cache['lastbuild'][job] = result
+        self.failed.discard(job)
+        self.invalidate()
+
+    def collect(self):
+        """Store results of refreshes that ended since they were waited
+        for, return True if there was any"""
+        collected = False
+        while True:
+            try:
+                job, result, exc = self.results.get_nowait()
+            except queue.Empty:
+                return collected
+            self.storeresult(job, result, exc)
+            collected = True
+
+    def flush(self):
+        """Save the store if it has been modified since it was loaded,
+        with results of refreshes that ended meanwhile"""
+        self.collect()
+        if self.dirty:
+            self.save()
 
     def clear(self):
-        self.svfs.unlink(b'jenkins')
+        self.svfs.tryunlink(b'jenkins')
+        self.svfs.tryunlink(b'jenkins.bin')
+
+    def invalidate(self):
+        """Flag the store as modified, to be called when builds change"""
+        self.dirty = True
+        self._bystatus = None
+
+    def indexstatus(self):
+        """Compute sets of hg-nodes by job and build status"""
+        bystatus = {}
+        for job, jobcache in self.cache.get('jobs', {}).items():
+            nodes = bystatus[job] = defaultdict(set)
+            for hgnode, info in jobcache.items():
+                nodes[buildstatus(info)].add(hgnode)
+        self._bystatus = bystatus
+
+    def nodes(self, job, status=None):
+        """Return hex hg-nodes built by `job`, restricted to builds of
+        given `status` if specified"""
+        if self._bystatus is None:
+            # only needed by the revset predicate, not by template keywords
+            # looking up a few nodes
+            self.indexstatus()
+        nodes = self._bystatus.get(job, {})
+        if status is not None:
+            return nodes.get(status, set())
+        return set().union(*nodes.values())
+
+
+def buildstatus(info):
+    """Return the status of a build, "BUILDING" if it is running"""
+    return 'BUILDING' if info['building'] else info['status']
+
+
+def gettrace(ui):
+    """Return the trace of the running command if Jenkins requests are
+    profiled (`jenkins.trace` or `jenkins.trace-file` config entries), None
+    otherwise. The trace is reported when the command ends.
+    """
+    trace = getattr(ui, '_jenkinstrace', None)
+    if trace is None and (ui.configbool(b'jenkins', b'trace')
+                          or ui.config(b'jenkins', b'trace-file')):
+        trace = ui._jenkinstrace = RemoteTrace()
+        path = ui.config(b'jenkins', b'trace-file')
+
+        def report():
+            if path:
+                trace.dump(path)
+            else:
+                trace.write(ui)
 
+        if util.safehasattr(ui, 'atexit'):
+            ui.atexit(report)
+    return trace
 
-def showbuildstatus(context, mapping):
-    """:build_status: String. Status of build.
-    """
-    repo = context.resource(mapping, b'repo')
-    ui = repo.ui
-    debug = ui.debugflag
-    ctx = context.resource(mapping, b'ctx')
-    store = jenkinsstore(repo.svfs, repo[b'tip'].rev())
-    storecache = store.load(ui)
-    if debug:
-        if len(storecache) <= 1:
-            ui.debug(b'jenkins cache is empty\n')
-        else:
-            ui.debug(b'jenkins cache: {}\n'.format(storecache))
 
+def jenkinsserver(ui):
+    """Return a Jenkins server handle from "jenkins" configuration"""
     url = ui.config(b'jenkins', b'url')
     if not url:
         raise error.Abort('jenkins.url configuration option is not defined')
-    res = httpconnectionmod.readauthforuri(repo.ui, url, util.url(url).user)
+    res = httpconnectionmod.readauthforuri(ui, url, util.url(url).user)
     if res:
         group, auth = res
         ui.debug(b"using auth.%s.* for authentication\n" % group)
@@ -153,34 +593,200 @@ def showbuildstatus(context, mapping):
         username, password = None, None
     username = ui.config(b'jenkins', b'username')
     password = ui.config(b'jenkins', b'password')
-    server = Jenkins(url.decode('utf-8'), username=username, password=password)
+    timeout = ui.configint(b'jenkins', b'timeout', TIMEOUT)
+    server = Jenkins(url.decode('utf-8'), username=username,
+                     password=password, timeout=timeout)
+    trace = gettrace(ui)
+    if trace is not None and util.safehasattr(server, '_session'):
+        server._session.hooks['response'].append(trace.hook('jenkins'))
+    return server
+
+
+def refreshjobs(ui, store, server):
+    """Refresh outdated or empty jobs of `store`, from at most
+    `jenkins.workers` threads.
+
+    Jobs whose refresh fails or is not over after `jenkins.timeout` seconds
+    are added to `store.failed`. Refreshes still running then go on in
+    daemon threads, which do not delay the end of the command: their result
+    is stored if they end before the store is saved (see `store.flush`).
+    """
+    storecache = store.cache
+    lastbuild = storecache['lastbuild']
+    jobs = [job for job, jobcache in storecache['jobs'].items()
+            if job not in store.refreshed and (not jobcache or store.outdated)]
+    if not jobs:
+        return
+    pagesize = ui.configint(b'jenkins', b'page-size', PAGESIZE)
+    timeout = ui.configint(b'jenkins', b'timeout', TIMEOUT)
+    workers = ui.configint(b'jenkins', b'workers', WORKERS)
+    todo = queue.Queue()
+    for job in jobs:
+        todo.put((job, lastbuild.get(job, 0),
+                  # work on a copy, so that a job that timed out cannot
+                  # alter the store
+                  {hgnode: dict(info)
+                   for hgnode, info in storecache['jobs'][job].items()}))
+
+    def worker():
+        while True:
+            try:
+                job, last, jobcache = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                last = refresh_buildinfo_for_job(server, job, jobcache, last,
+                                                 pagesize)
+            except Exception as exc:
+                store.results.put((job, None, exc))
+            else:
+                store.results.put((job, (jobcache, last), None))
+
+    for i in range(min(max(workers, 1), len(jobs))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    store.refreshed.update(jobs)
+    pending = set(jobs)
+    deadline = time.time() + timeout
+    while pending:
+        try:
+            job, result, exc = store.results.get(
+                timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            break
+        pending.discard(job)
+        if isinstance(exc, error.ConfigError):
+            raise exc
+        elif exc is not None:
+            ui.warn(b'cannot fetch builds of job %s: %s\n'
+                    % (job.encode('utf-8'), str(exc).encode('utf-8')))
+        store.storeresult(job, result, exc)
+    for job in sorted(pending):
+        ui.warn(b'timeout while fetching builds of job %s\n'
+                % job.encode('utf-8'))
+        store.failed.add(job)
+
+
+def storekey(repo):
+    """Return the tip revision of `repo` and the mtime and size of its
+    Jenkins store files, which change when the store must be reloaded"""
+    key = [len(repo.unfiltered().changelog)]
+    for name in (b'jenkins', b'jenkins.bin'):
+        try:
+            st = repo.svfs.stat(name)
+        except OSError:
+            key.append(None)
+        else:
+            key.append((st.st_mtime, st.st_size))
+    return tuple(key)
+
+
+def loadstore(repo, cache, refresh=False):
+    """Return the (store, server) pair of current command.
+
+    They are built once per command and kept in templater `cache`; the
+    store is saved, if modified, when the command ends.
+
+    Jobs are refreshed if `refresh` is True or if the store is outdated,
+    unless refreshing is left to a background process (see `refreshhook`).
+    """
+    if 'jenkins' in cache:
+        return cache['jenkins']
+    # (key, store, server) set while watching builds, so that they are
+    # shared by every redraw; unless key is None, only used until the store
+    # file or tip changes (long-lived processes such as the command server)
+    state = getattr(repo.unfiltered(), '_jenkinsstate', None)
+    if state is not None and state[0] in (None, storekey(repo)):
+        cache['jenkins'] = state[1:]
+        return state[1:]
+    ui = repo.ui
+    store = jenkinsstore(repo.svfs, repo[b'tip'].rev(),
+                         ui.config(b'jenkins', b'store-format', b'json'))
+    storecache = store.load(ui)
+    if ui.debugflag:
+        if 'jobs' not in storecache:
+            ui.debug(b'jenkins cache is empty\n')
+        else:
+            ui.debug(b'jenkins cache: {}\n'.format(storecache))
+    server = jenkinsserver(ui)
 
     if 'jobs' not in storecache:
         jobnames = ui.config(b'jenkins', b'job').decode('utf-8')
         jobs = [n.strip() for n in jobnames.split(',')]
         storecache['jobs'] = {name: {} for name in jobs}
-    elif debug:
+        store.dirty = True
+    else:
         ui.debug(b'using cached jobs\n')
 
+    if refresh:
+        store.outdated = True
+    elif store.outdated and ui.configbool(b'jenkins', b'background-refresh'):
+        # do not wait for Jenkins, nor overwrite what the background
+        # process stores
+        store.outdated = store.dirty = False
+    refreshjobs(ui, store, server)
+    if util.safehasattr(ui, 'atexit'):
+        ui.atexit(store.flush)
+    cache['jenkins'] = store, server
+    return store, server
+
+
+def readstore(repo):
+    """Return the Jenkins store of `repo` as last saved, without contacting
+    Jenkins.
+
+    The store is kept until the store file or tip changes, so that
+    long-lived processes (such as the command server) read it once.
+    """
+    unfi = repo.unfiltered()
+    state = getattr(unfi, '_jenkinsstate', None)
+    if state is not None and state[0] in (None, storekey(repo)):
+        return state[1]
+    key = storekey(repo)
+    state = getattr(unfi, '_jenkinsread', None)
+    if state is not None and state[0] == key:
+        return state[1]
+    ui = repo.ui
+    store = jenkinsstore(repo.svfs, repo[b'tip'].rev(),
+                         ui.config(b'jenkins', b'store-format', b'json'))
+    store.load(ui)
+    unfi._jenkinsread = key, store
+    return store
+
+
+def showbuildstatus(context, mapping):
+    """:build_status: String. Status of build.
+    """
+    repo = context.resource(mapping, b'repo')
+    ui = repo.ui
+    debug = ui.debugflag
+    ctx = context.resource(mapping, b'ctx')
+    store, server = loadstore(repo, context.resource(mapping, b'cache'))
+    storecache = store.cache
+    trace = gettrace(ui)
+
     def gen_jobs_buildinfo():
         for job, jobcache in storecache['jobs'].items():
-            if not jobcache:
-                jobcache.update(buildinfo_for_job(server, job))
+            if job in store.failed:
+                yield '{}: UNKNOWN\n'.format(job)
+                continue
             elif debug:
                 ui.debug(b'using cached build info for job %s\n' % job)
             build_info = jobcache.get(ctx.hex().decode('utf-8'))
+            if trace is not None:
+                trace.record('store', job, cache='hit' if build_info
+                             else 'miss')
             if not build_info:
                 yield '{}: NOT BUILT\n'.format(job)
                 continue
-            if build_info['building']:
-                status = 'BUILDING'
-            else:
-                status = build_info['status']
+            status = buildstatus(build_info)
             build_url = build_info['url']
             yield '{}: {} - {}\n'.format(job, status, build_url)
 
     jobs_buildinfo = [v.encode('utf-8') for v in gen_jobs_buildinfo()]
-    store.save()
+    if not util.safehasattr(ui, 'atexit'):
+        store.flush()
 
     if not jobs_buildinfo:
         jobs_buildinfo.append(b'NOT BUILT')
@@ -189,6 +795,37 @@ def showbuildstatus(context, mapping):
                                  jobs_buildinfo)
 
 
+def revsetjenkins(repo, subset, x):
+    """Changesets built by Jenkins `job`, or whose latest build by `job`
+    has given `status` (e.g. SUCCESS, FAILURE or BUILDING), according to
+    the store (see `hg debugjenkins --refresh`).
+    """
+    args = revsetlang.getargs(x, 1, 2,
+                              b'jenkins takes one or two arguments')
+    job = revsetlang.getstring(
+        args[0], b'jenkins requires a job name').decode('utf-8')
+    status = None
+    if len(args) > 1:
+        status = revsetlang.getstring(
+            args[1], b'jenkins requires a build status').decode('utf-8')
+        status = status.upper()
+    store = readstore(repo)
+    jobnames = repo.ui.config(b'jenkins', b'job', b'').decode('utf-8')
+    jobs = set(store.cache.get('jobs', ()))
+    jobs.update(n.strip() for n in jobnames.split(',') if n.strip())
+    if job not in jobs:
+        raise error.Abort(b'unknown Jenkins job: %s' % job.encode('utf-8'))
+    cl = repo.changelog
+    revs = set()
+    for hgnode in store.nodes(job, status):
+        try:
+            revs.add(cl.rev(binascii.unhexlify(hgnode)))
+        except error.LookupError:
+            # unknown or filtered
+            continue
+    return subset & smartset.baseset(sorted(revs))
+
+
 try:
     from hgext.show import showview
 except ImportError:
@@ -228,9 +865,124 @@ else:
         displayer = changesettemplater(ui, repo, spec, buffered=True)
         displaygraph(ui, repo, revdag, displayer, graphmod.asciiedges)
 
+    def _renderjenkins(ui, repo):
+        ui.pushbuffer()
+        try:
+            showjenkins(ui, repo)
+        finally:
+            output = ui.popbuffer()
+        return output.splitlines()
+
+    def _redraw(ui, oldlines, newlines):
+        """Display `newlines` in place of `oldlines`, only rewriting rows
+        that changed"""
+        if not ui.formatted():
+            # no cursor to move, only print what changed
+            for idx, line in enumerate(newlines):
+                if idx >= len(oldlines) or oldlines[idx] != line:
+                    ui.write(line + b'\n')
+        elif len(oldlines) != len(newlines):
+            ui.write(b''.join(line + b'\n' for line in newlines))
+        else:
+            # move the cursor up to the first row, then rewrite changed
+            # rows and skip the others
+            ui.write(b'\x1b[%dA' % len(oldlines))
+            for oldline, newline in zip(oldlines, newlines):
+                if oldline != newline:
+                    ui.write(b'\r\x1b[2K' + newline)
+                ui.write(b'\n')
+        ui.flush()
+
+    def watchjenkins(ui, repo):
+        """Display the "jenkins" view, then poll builds still running and
+        update rows of the view as their status changes.
+
+        Polls happen every `jenkins.watch-interval` seconds; this interval
+        is doubled, up to `jenkins.watch-max-interval`, while no build
+        changes.
+        """
+        interval = ui.configint(b'jenkins', b'watch-interval', WATCH_INTERVAL)
+        maxinterval = ui.configint(b'jenkins', b'watch-max-interval',
+                                   WATCH_MAX_INTERVAL)
+        interval = max(interval, 1)
+        # load the store and connect once, for every redraw
+        store, server = loadstore(repo, {})
+        unfi = repo.unfiltered()
+        unfi._jenkinsstate = None, store, server
+        try:
+            lines = _renderjenkins(ui, repo)
+            ui.write(b''.join(line + b'\n' for line in lines))
+            ui.flush()
+            delay = interval
+            while hasbuilding(store.cache):
+                time.sleep(delay)
+                if not pollbuilding(ui, store, server):
+                    delay = min(delay * 2, max(maxinterval, interval))
+                    continue
+                delay = interval
+                newlines = _renderjenkins(ui, repo)
+                _redraw(ui, lines, newlines)
+                lines = newlines
+            ui.status(b'no build running\n')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            del unfi._jenkinsstate
+            store.flush()
+
+    def showwatch(orig, ui, repo, view=None, **opts):
+        if not opts.pop(r'watch', None):
+            return orig(ui, repo, view, **opts)
+        if view != b'jenkins':
+            raise error.Abort(b'--watch is only supported by "jenkins" view')
+        return watchjenkins(ui, repo)
+
+
+def refreshstore(ui, repo):
+    """Fetch new builds of all jobs into Jenkins store, unless another
+    process is already doing so"""
+    try:
+        lock = lockmod.lock(repo.svfs, b'jenkins.lock', timeout=0)
+    except error.LockHeld:
+        ui.status(b'Jenkins store is already being refreshed\n')
+        return
+    try:
+        store, server = loadstore(repo, {}, refresh=True)
+        store.flush()
+    finally:
+        lock.release()
+
+
+def refreshhook(ui, repo, **kwargs):
+    """hook refreshing Jenkins store in a detached background process"""
+    cmd = [procutil.hgexecutable(), b'-R', repo.root,
+           b'debugjenkins', b'--refresh']
+    if util.safehasattr(procutil, 'runbgcommand'):
+        procutil.runbgcommand(cmd, encoding.environ)
+    else:
+        # Mercurial < 4.9
+        procutil.spawndetached(cmd)
+
+
+def reposetup(ui, repo):
+    if repo.local() and repo.ui.configbool(b'jenkins', b'background-refresh'):
+        for hook in (b'post-pull', b'post-commit'):
+            repo.ui.setconfig(b'hooks', hook + b'.jenkins', refreshhook,
+                              b'jenkins')
+
 
 def extsetup(ui):
     if ui.config(b'jenkins', b'url'):
         templatekw.templatekeyword(
-            b'build_status', requires={'ctx', 'repo'},
+            b'build_status', requires={'ctx', 'repo', 'cache'},
         )(showbuildstatus)
+        revsetpredicate(b'jenkins(job[, status])')(revsetjenkins)
+    try:
+        showmod = extensions.find(b'show')
+    except KeyError:
+        pass
+    else:
+        entry = extensions.wrapcommand(showmod.cmdtable, b'show', showwatch)
+        entry[1].append((b'', b'watch', None,
+                         b'poll running builds and update the view '
+                         b'(jenkins view only)'))
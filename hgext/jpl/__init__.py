@@ -23,6 +23,75 @@ or, according cwo is the id of the endpoint in your cwclientlib_ config file::
   [jpl]
   endpoint = cwo
 
+Requests to a same forge share a pool of keep-alive connections; pool size,
+timeouts (in seconds) and retries of read queries can be configured::
+
+  [jpl]
+  pool-size = 4
+  connect-timeout = 10
+  read-timeout = 60
+  retries = 2
+  retry-backoff = 0.5
+
+`show-review --test-results` runs up to `concurrency` (default 4) queries
+at the same time::
+
+  [jpl]
+  concurrency = 8
+
+Results of the revset functions are cached on disk for `cache-ttl` seconds
+(default 600; with 0, the cache is neither read nor written, even offline).
+With `cache-stale` set, expired results are used while being refreshed in the
+background::
+
+  [jpl]
+  cache-ttl = 3600
+  cache-stale = yes
+
+Expired results are kept for offline use, until they are `cache-max-age`
+seconds old (default 604800, a week)::
+
+  [jpl]
+  cache-max-age = 86400
+
+Use `hg debugjpl --clear-cache` to drop cached results.
+
+In offline mode (`--offline` option or `offline` config entry), read-only
+commands display the last results fetched from the forge, and `ask-review`,
+`acknowledge`, `assign` and `add-reviewer` are queued in a journal that is
+sent to the forge by the next command run online (they are also queued when
+the forge cannot be reached). Operations the forge rejects are reported and
+dropped; use `hg debugjpl --journal` to list queued operations and `hg
+debugjpl --clear-journal` to drop them. `make-ticket` and `start-test` always
+need the forge::
+
+  [jpl]
+  offline = yes
+
+`reviewed()` sends the changesets to filter to the forge when there are at
+most `pushdown-threshold` (default 1000) of them, and fetches every reviewed
+patch of the repository otherwise. The repository is identified by its first
+public changeset; if the forge does not know it, patches of every repository
+are considered::
+
+  [jpl]
+  pushdown-threshold = 5000
+
+Requests sent to the forge, with their latency, the size of their reply and
+whether cached results were used, are reported when a command ends if the
+`--profile-remote` option or the `trace` config entry is set. With
+`trace-file`, they are written to given file as JSON instead::
+
+  [jpl]
+  trace = yes
+  trace-file = /tmp/jpl-trace.json
+
+Changesets are sent to the forge by batches of at most `chunk-size`
+(default 100) changesets per query::
+
+  [jpl]
+  chunk-size = 200
+
 You may need `python-ndg-httpsclient`_ and `python-openssl`_ if
 the forge application is using a SNI_ ssl configuration (ie. if you
 get errors like::
@@ -37,8 +106,10 @@ get errors like::
 
 '''
 from cStringIO import StringIO
+import inspect
 
-from mercurial import cmdutil, scmutil, util, node, demandimport
+from mercurial import (cmdutil, scmutil, util, node, demandimport,
+                       dispatch, extensions, error)
 from mercurial.i18n import _
 import mercurial.revset
 import mercurial.templatekw
@@ -49,11 +120,27 @@ except AttributeError:
     enabled = demandimport._import is __import__
 demandimport.disable()  # noqa
 
-from .jplproxy import build_proxy
-from .tasks import print_tasks
-from .review import (ask_review, acknowledge, add_reviewer, show_review,
-                     sudo_make_me_a_ticket, assign)
+try:
+    from mercurial import logcmdutil
+    # another extension may have left a lazy, failing, import of it
+    getattr(logcmdutil, 'getrevs', None)
+except ImportError:
+    # Mercurial < 4.6
+    logcmdutil = None
+try:
+    from mercurial.smartset import baseset
+except ImportError:
+    # Mercurial < 4.1
+    from mercurial.revset import baseset
+from .jplproxy import (build_proxy, chunked, getchunksize, getintopt,
+                       imap_unordered, isoffline, CONCURRENCY)
+from .cache import cachedquery, getcache
+from .offline import (CachedProxy, Journal, describe, forge_proxy,
+                      run_or_queue)
+from .tasks import prefetch_tasks, write_tasks
+from .review import show_review, sudo_make_me_a_ticket
 from .apycot import create_test_execution, list_tc
+from .trace import gettrace
 if enabled:
     demandimport.enable()
 
@@ -92,6 +179,21 @@ WHERE P in_state T,
                  P patch_revision RE)
 """
 
+REPORQL = """,
+      ROOT from_repository RP,
+      ROOT changeset %(root)s
+"""
+
+ROOTRQL = "Any R WHERE R changeset %(root)s"
+
+CSETSRQL = """,
+      TIP changeset IN ({revs})
+"""
+
+# above this number of revisions, reviewed() fetches all reviewed patches
+# instead of sending revisions to the forge
+PUSHDOWN_THRESHOLD = 1000
+
 IVRQL = """
 Any PO, RC, T
 GROUPBY PO, P, T, RC
@@ -109,6 +211,13 @@ WHERE P patch_revision TIP,
       P patch_ticket T
 """
 
+TESTRESULTSRQL = (
+    'Any PEN, TCN, ST WHERE TE status ST, '
+    'TE using_revision REV, '
+    'REV changeset %(cset)s, '
+    'TE using_environment PE, PE name PEN, '
+    'TE using_config TC, TC name TCN')
+
 TASKSRQL = """
 DISTINCT Any RC
 WHERE P patch_revision TIP,
@@ -122,15 +231,64 @@ WHERE P patch_revision TIP,
 """
 
 
+def _shortstorevs(repo, shorts):
+    """Return the set of revisions matching given short hashes, looked up in
+    the changelog node index"""
+    cl = repo.changelog
+    revs = set()
+    for short in set(shorts):
+        try:
+            n = cl._partialmatch(str(short))
+            if n is not None:
+                revs.add(cl.rev(n))
+        except error.LookupError:
+            # ambiguous, unknown or filtered
+            continue
+    return revs
+
+
+def _matchshorts(repo, subset, shorts):
+    """Return revisions of `subset` whose node matches one of given short
+    hashes"""
+    return subset & baseset(sorted(_shortstorevs(repo, shorts)))
+
+
+def _reporoot(repo):
+    """Return RQL arguments identifying this repository in the forge by its
+    root, or None if it has no public changeset or if the forge does not
+    know its root"""
+    roots = repo.revs('first(public())')
+    if not roots:
+        return None
+    args = {'root': node.short(repo.changelog.node(roots.first()))}
+    if cachedquery(repo, ROOTRQL, args) == []:
+        # e.g. history rewritten since the repository was registered in the
+        # forge: do not restrict to patches of this repository
+        return None
+    return args
+
+
 def reviewed(repo, subset, x):
     """
     return changesets that are linked to reviewed patch in the jpl forge
     """
     mercurial.revset.getargs(x, 0, 0, _("reviewed takes no arguments"))
-    with build_proxy(repo.ui) as client:
-        data = client.rql(RQL)
-    all = set(short for po, short, p in data)
-    return [r for r in subset if str(repo[r]) in all]
+    rql, args = RQL, _reporoot(repo)
+    if args is not None:
+        rql += REPORQL
+    threshold = repo.ui.configint('jpl', 'pushdown-threshold',
+                                  PUSHDOWN_THRESHOLD)
+    if len(subset) <= threshold:
+        # small subset: only ask for its changesets
+        data = []
+        shorts = (node.short(repo.changelog.node(r)) for r in subset)
+        for chunk in chunked(shorts, getchunksize(repo.ui)):
+            query = rql + CSETSRQL.format(
+                revs=','.join('%r' % short for short in chunk))
+            data.extend(cachedquery(repo, query, args) or ())
+    else:
+        data = cachedquery(repo, rql, args) or ()
+    return _matchshorts(repo, subset, (short for po, short, p in data))
 
 
 def inversion(repo, subset, x):
@@ -140,11 +298,8 @@ def inversion(repo, subset, x):
     """
     version = mercurial.revset.getargs(
         x, 1, 1, _("inversion takes one argument"))[0][1]
-    with build_proxy(repo.ui) as client:
-        args = {'version': version}
-        data = client.execute(IVRQL, args)
-    all = set(short for po, short, p in data)
-    return [r for r in subset if str(repo[r]) in all]
+    data = cachedquery(repo, IVRQL, {'version': version}) or ()
+    return _matchshorts(repo, subset, (short for po, short, p in data))
 
 
 def tasks_predicate(repo, subset, x=None):
@@ -165,22 +320,75 @@ def tasks_predicate(repo, subset, x=None):
         states = 'IN ({})'.format(
             ','.join('"{}"'.format(state) for state in states))
     rql = TASKSRQL.format(states=states)
-    with build_proxy(repo.ui) as client:
-        data = client.rql(rql)
-    all = set(short[0] for short in data)
-    return [r for r in subset if str(repo[r]) in all]
+    data = cachedquery(repo, rql) or ()
+    return _matchshorts(repo, subset, (short[0] for short in data))
+
+
+# Mercurial >= 4.4 takes the template mapping as a positional argument
+_SHOWLISTMAPPING = 'mapping' in inspect.getargspec(
+    mercurial.templatekw.showlist).args
 
 
 def showtasks(**args):
     ":tasks: List of Strings. The text of the tasks and comments of a patch."
-    output = _MockOutput()
-    with build_proxy(output, args) as client:
-        try:
-            print_tasks(client, output,
-                        iter([node.short(args['ctx'].node())]), {})
-        except Exception:
-            return ''
-    return mercurial.templatekw.showlist('task', list(output), **args)
+    repo, ctx = args['repo'], args['ctx']
+    cache = args['cache'].setdefault('jpltasks', {})
+    cset = node.short(ctx.node())
+    if cset not in cache:
+        # prefetch tasks of the next displayed changesets not seen yet, so
+        # the forge is queried once per chunk instead of once per changeset
+        csets = [cset]
+        csets.extend(c for c in _nextdisplayed(repo, args['cache'], ctx)
+                     if c != cset and c not in cache)
+        cache.update(dict.fromkeys(csets))
+        with build_proxy(repo.ui) as client:
+            client = CachedProxy(client, getcache(repo), isoffline(repo.ui))
+            try:
+                rows = prefetch_tasks(client, csets)
+            except util.Abort as exc:
+                # forge unreachable and no cached result
+                repo.ui.warn(_('cannot fetch tasks: %s\n') % exc)
+                rows = {}
+            if not isinstance(rows, dict):
+                repo.ui.warn(_('cannot fetch tasks: %s\n') % rows)
+                rows = {}
+            for short, patchesdata in rows.items():
+                if patchesdata:
+                    output = _MockOutput()
+                    write_tasks(client, output, patchesdata)
+                    cache[short] = list(output)
+    if not cache.get(cset):
+        return ''
+    if _SHOWLISTMAPPING:
+        return mercurial.templatekw.showlist('task', cache[cset], args)
+    return mercurial.templatekw.showlist('task', cache[cset], **args)
+
+
+def _nextdisplayed(repo, cache, ctx):
+    """Return changesets (short hex) displayed by the running log-like
+    command from `ctx` on, at most `chunk-size` of them, using revisions
+    recorded by `_recorddisplayedrevs` (moved to templater `cache`)"""
+    displayed = getattr(repo, '_jpldisplayedrevs', None)
+    if displayed is not None:
+        del repo._jpldisplayedrevs
+        revs = list(displayed)
+        cache['jpldisplayed'] = (revs, dict((rev, idx)
+                                            for idx, rev in enumerate(revs)))
+    revs, index = cache.get('jpldisplayed', ((), {}))
+    idx = index.get(ctx.rev())
+    if idx is None:
+        return []
+    cl = repo.changelog
+    return [node.short(cl.node(rev))
+            for rev in revs[idx:idx + getchunksize(repo.ui)]]
+
+
+def _recorddisplayedrevs(orig, repo, *args, **kwargs):
+    """remember revisions about to be displayed by log-like commands so
+    that the `tasks` template keyword can prefetch them"""
+    result = orig(repo, *args, **kwargs)
+    repo._jpldisplayedrevs = result[0]
+    return result
 
 
 class _MockOutput(object):
@@ -197,20 +405,69 @@ class _MockOutput(object):
             yield io.getvalue()
 
 
+def _runcommand(orig, lui, repo, cmd, fullargs, ui, options, d, cmdpats,
+                cmdoptions):
+    # start the trace of forge requests before the command runs, so that
+    # requests sent by revset functions resolving its revisions are recorded
+    # with --profile-remote as well
+    gettrace(ui, cmdoptions)
+    return orig(lui, repo, cmd, fullargs, ui, options, d, cmdpats,
+                cmdoptions)
+
+
+def uisetup(ui):
+    extensions.wrapfunction(dispatch, 'runcommand', _runcommand)
+
+
 def extsetup(ui):
     if ui.config('jpl', 'endpoint'):
         mercurial.revset.symbols['reviewed'] = reviewed
         mercurial.revset.symbols['tasks'] = tasks_predicate
         mercurial.revset.symbols['inversion'] = inversion
         mercurial.templatekw.keywords['tasks'] = showtasks
+        for mod, name in ((cmdutil, 'getlogrevs'),
+                          (cmdutil, 'getgraphlogrevs'),
+                          (logcmdutil, 'getrevs')):
+            if mod is not None and util.safehasattr(mod, name):
+                extensions.wrapfunction(mod, name, _recorddisplayedrevs)
 
 
-cnxopts = [
+# options of commands that need the forge
+onlineopts = [
     ('U', 'endpoint', '',
      _('endpoint (ID or URL) of the configured cwclientlib '
        'forge (jpl) server'), _('ENDPOINT')),
+    ('', 'profile-remote', False,
+     _('report the requests sent to the forge when the command ends')),
     ]
 
+cnxopts = onlineopts + [
+    ('', 'offline', False,
+     _('do not contact the forge, use cached results and queue '
+       'changes')),
+    ]
+
+
+@command('debugjpl', [
+    ('', 'clear-cache', None, _('clear the forge cache')),
+    ('', 'journal', None, _('list operations queued while offline')),
+    ('', 'clear-journal', None, _('drop operations queued while offline')),
+    ] + cnxopts,
+    _('[OPTION]...'))
+def debugjpl(ui, repo, **opts):
+    """debug actions for 'jpl' extension."""
+    journal = Journal(repo.vfs)
+    if opts.get('journal'):
+        for entry in journal.read():
+            ui.write('%s\n' % describe(entry))
+    if opts.get('clear_cache'):
+        getcache(repo, opts).clear()
+    if opts.get('clear_journal'):
+        journal.clear()
+    if not (opts.get('journal') or opts.get('clear_cache')
+            or opts.get('clear_journal')):
+        ui.warn(_('no option specified, did nothing\n'))
+
 
 @command('^tasks', [
     ('r', 'rev', [], _('tasks for the given revision(s)'), _('REV')),
@@ -245,16 +502,57 @@ def tasks(ui, repo, *changesets, **opts):
     # we need to see hidden cs from here
     repo = repo.unfiltered()
 
+    precursors = _precursorsmap(repo, revs)
+
+    def short(rev):
+        return node.short(repo.changelog.node(rev))
+
+    ctxhexs = set(short(prec) for precs in precursors.values()
+                  for prec in precs)
+    showall = opts.get('all', None)
+    with forge_proxy(repo, opts) as client:
+        try:
+            rows = prefetch_tasks(client, ctxhexs, showall=showall)
+        except Exception:
+            rows = {}
+        if not isinstance(rows, dict):
+            ui.warn(_('error: %s\n') % rows)
+            rows = {}
+        for rev in revs:
+            patchesdata = set()
+            for prec in precursors[rev]:
+                patchesdata.update(tuple(row) for row in
+                                   rows.get(short(prec), ()))
+            if not patchesdata:
+                ui.write('no patch or no tasks for %s\n' % short(rev))
+                continue
+            # keep rows of a same patch together, by revision like the forge
+            write_tasks(client, ui, sorted(patchesdata,
+                                           key=lambda row: (row[0], row[3])))
+
+
+def _precursorsmap(repo, revs):
+    """Return a {rev: [rev and its precursors]} dict, with a single revset
+    evaluation for all given revisions"""
+    cl = repo.changelog
+    known = dict((cl.node(rev), rev)
+                 for rev in repo.revs('%ld or allprecursors(%ld)', revs, revs))
+    obsstore = repo.obsstore
+    markers = getattr(obsstore, 'predecessors', None)
+    if markers is None:
+        # Mercurial < 4.4
+        markers = obsstore.precursors
+    result = {}
     for rev in revs:
-        precs = scmutil.revrange(repo, (rev, 'allprecursors(%s)' % rev))
-        ctxhexs = list((node.short(repo.lookup(lrev)) for lrev in precs))
-        showall = opts.get('all', None)
-        with build_proxy(ui, opts) as client:
-            try:
-                print_tasks(client, ui, ctxhexs, showall=showall)
-            except Exception as e:
-                ui.write('no patch or no tasks for %s\n'
-                         % node.short(repo.lookup(rev)))
+        seen = set([cl.node(rev)])
+        stack = list(seen)
+        while stack:
+            for mark in markers.get(stack.pop(), ()):
+                if mark[0] not in seen:
+                    seen.add(mark[0])
+                    stack.append(mark[0])
+        result[rev] = sorted(known[n] for n in seen if n in known)
+    return result
 
 
 @command('^ask-review', [
@@ -276,8 +574,7 @@ def askreview(ui, repo, *changesets, **opts):
         raise util.Abort(_('no working directory: please specify a revision'))
     ctxhexs = (node.short(repo.lookup(rev)) for rev in revs)
 
-    with build_proxy(ui, opts) as client:
-        ask_review(client, ctxhexs)
+    if run_or_queue(ui, repo, opts, 'ask-review', ctxhexs):
         ui.write('OK\n')
 
 
@@ -300,8 +597,7 @@ def accept(ui, repo, *changesets, **opts):
         raise util.Abort(_('no working directory: please specify a revision'))
     ctxhexs = (node.short(repo.lookup(rev)) for rev in revs)
 
-    with build_proxy(ui, opts) as client:
-        acknowledge(client, ctxhexs)
+    run_or_queue(ui, repo, opts, 'acknowledge', ctxhexs)
     showreview(ui, repo, *changesets, **opts)
 
 
@@ -337,20 +633,52 @@ def showreview(ui, repo, *changesets, **opts):
             if revid in ctxhexs:
                 return ctxhexs.index(revid)
 
-    with build_proxy(ui, opts) as client:
-        review_results = show_review(client, ctxhexs, committer)
+    concurrency = getintopt('concurrency', ui, opts, CONCURRENCY)
+    with forge_proxy(repo, opts) as client:
+        calls = {'review': lambda: show_review(client, ctxhexs, committer)}
         if opts.get('test_results'):
-            rql = ('Any PEN, TCN, ST WHERE TE status ST, '
-                   'TE using_revision REV, '
-                   'REV changeset %(cset)s, '
-                   'TE using_environment PE, PE name PEN, '
-                   'TE using_config TC, TC name TCN')
-            queries = [(rql, dict(cset=cset)) for cset in ctxhexs]
-            test_results = dict(zip(ctxhexs, client.rqlio(queries)))
+            for chunk in chunked(ctxhexs, getchunksize(ui, opts)):
+                queries = [(TESTRESULTSRQL, dict(cset=cset))
+                           for cset in chunk]
+                calls[tuple(chunk)] = (
+                    lambda queries=queries: client.rqlio(
+                        queries, readonly=True))
+            test_results = {}
         else:
             test_results = None
-        review_results.sort(key=rset_revision_index, reverse=True)
-        _format_review_result(ui, repo, client, review_results, test_results)
+        # display patches, in order, as soon as their review status and
+        # test results are known
+        review_results = None
+        for key, result in imap_unordered(lambda key: calls[key](), calls,
+                                          concurrency):
+            if key == 'review':
+                review_results = sorted(result, key=rset_revision_index,
+                                        reverse=True)
+            elif isinstance(result, list):
+                test_results.update(zip(key, result))
+            else:
+                test_results.update((cset, []) for cset in key)
+            while review_results:
+                rids = _latestrid(repo, review_results[0][2])
+                if test_results is not None and rids not in test_results:
+                    break
+                _format_review_result(ui, repo, client,
+                                      [review_results.pop(0)], test_results)
+        if review_results:
+            # revisions for which no test results were asked
+            _format_review_result(ui, repo, client, review_results,
+                                  test_results)
+
+
+def _latestrid(repo, rids):
+    """Return the short hash of the most recent revision among the comma
+    separated `rids`"""
+    if ',' not in rids:
+        return rids
+    revs = _shortstorevs(repo, [rid.strip() for rid in rids.split(',')])
+    if not revs:
+        return rids
+    return node.short(repo.changelog.node(max(revs)))
 
 
 def _format_review_result(ui, repo, client, revs, test_results=None):
@@ -358,9 +686,7 @@ def _format_review_result(ui, repo, client, revs, test_results=None):
     for pname, eid, rids, status, victims in revs:
         uri = client.build_url(str(eid))
         ui.write("{0}".format(uri), label='jpl.cwuri')
-        if ',' in rids:
-            revs = repo.revs('max({})'.format(rids.replace(',', ' or ')))
-            rids = node.short(repo.lookup(revs.first()))
+        rids = _latestrid(repo, rids)
         ui.write(" {0}".format(rids))
         ui.write("\t[{0}]".format(status),
                  label='jpl.status.{0}'.format(status))
@@ -377,20 +703,46 @@ def _format_review_result(ui, repo, client, revs, test_results=None):
 @command('^backlog', [
     ('c', 'committer', '',
      _('login of the committer in JPL forge'), _('LOGIN')),
+    ('l', 'limit', '',
+     _('only consider the LIMIT most recent draft changesets'), _('NUM')),
+    ('', 'since', '',
+     _('only consider draft changesets committed since DATE'), _('DATE')),
     ] + cnxopts,
     _('[OPTION]... -c LOGIN'))
 def backlog(ui, repo, *changesets, **opts):
     """show the backlog (draft changesets) of specified committer in the form
     of a review list.
+
+    Draft changesets are sent to the forge by batches, most recent first,
+    and patches are displayed as soon as each batch is answered.
     """
-    revs = repo.revs('draft()')
-    ctxhexs = (node.short(repo.lookup(rev)) for rev in revs)
+    since = opts.get('since')
+    if since:
+        revs = repo.revs('draft() and date(%s)', '>%s' % since)
+    else:
+        revs = repo.revs('draft()')
+    revs = sorted(revs, reverse=True)
+    limit = opts.get('limit')
+    if limit:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            raise util.Abort(_('limit must be a positive integer'))
+        revs = revs[:limit]
+    ctxhexs = (node.short(repo.changelog.node(rev)) for rev in revs)
 
     committer = opts.get('committer', None)
 
-    with build_proxy(ui, opts) as client:
-        rev = show_review(client, ctxhexs, committer)
-        _format_review_result(ui, repo, client, rev)
+    with forge_proxy(repo, opts) as client:
+        seen = set()
+        for chunk in chunked(ctxhexs, getchunksize(ui, opts)):
+            rows = [row for row in show_review(client, chunk, committer)
+                    if row[1] not in seen]
+            seen.update(row[1] for row in rows)
+            _format_review_result(ui, repo, client, rows)
+            ui.flush()
 
 
 @command('^assign', [
@@ -419,8 +771,7 @@ def patch_assign(ui, repo, *changesets, **opts):
     if not committer:
         raise util.Abort(_('unspecified committer login (-c LOGIN)'))
 
-    with build_proxy(ui, opts) as client:
-        assign(client, ctxhexs, committer)
+    if run_or_queue(ui, repo, opts, 'assign', ctxhexs, committer):
         ui.write('OK\n')
 
 
@@ -449,8 +800,7 @@ def addreviewer(ui, repo, *changesets, **opts):
     if not reviewer:
         raise util.Abort(_('unspecified reviewer login (-c LOGIN)'))
 
-    with build_proxy(ui, opts) as client:
-        add_reviewer(client, ctxhexs, reviewer)
+    if run_or_queue(ui, repo, opts, 'add-reviewer', ctxhexs, reviewer):
         ui.write('OK\n')
 
 
@@ -459,7 +809,7 @@ def addreviewer(ui, repo, *changesets, **opts):
     ('d', 'done-in', '',
      _('new ticket should be marked as done in this version'), _('VERSION')),
     ('t', 'type', '', _('type of ticket'), _('TYPE')),
-    ] + cnxopts,
+    ] + onlineopts,
     _('[OPTION]... [-d VERSION] [-t TYPE] [-r] REV'))
 def make_ticket(ui, repo, *changesets, **opts):
     """create new tickets for the specified revisions
@@ -487,7 +837,7 @@ def make_ticket(ui, repo, *changesets, **opts):
      _("the TestConfig's name to execute"), _('TCNAME')),
     ('o', 'option', [],
      _("options to add to the TestExecution"), _('OPTIONS')),
-    ] + cnxopts,
+    ] + onlineopts,
     _('[OPTION]... [-r] REV...'))
 def runapycot(ui, repo, *changesets, **opts):
     """start Apycot tests for the given revisions.
@@ -545,7 +895,7 @@ def listtc(ui, repo, *changesets, **opts):
         raise util.Abort(_('no working directory: please specify a revision'))
     ctxhexs = [node.short(repo.lookup(rev)) for rev in revs]
 
-    with build_proxy(ui, opts) as client:
+    with forge_proxy(repo, opts) as client:
         results = list_tc(client, ctxhexs)
         ui.write('{}\n'.format(
             '\n'.join('{0} ({1})'.format(str(tc), str(tn))
@@ -50,7 +50,7 @@ def list_tc(client, changesets):
     rql = LIST_TC_RQL
     queries = [(rql, dict(changeset=cs))
                for cs in changesets]
-    rsets = client.rqlio(queries)
+    rsets = client.rqlio(queries, readonly=True)
     result = set()
     for rset in rsets:
         for e in rset:
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+
+import hashlib
+import json
+import threading
+import time
+
+from mercurial import scmutil
+
+from .jplproxy import build_proxy, getcwcliopt, isoffline, URL
+from .trace import gettrace
+
+CACHEDIR = 'jpl'
+TTL = 600
+# age (in seconds) after which entries are removed from the cache
+MAXAGE = 7 * 86400
+# seconds between two removals of old entries
+PRUNE_INTERVAL = 3600
+PRUNE_STAMP = 'pruned'
+
+
+class ForgeCache(object):
+    """file-system cache for forge query results.
+
+    Entries are keyed by endpoint, query and query arguments and stored as
+    JSON files in a `jpl` directory of the given vfs (typically
+    `repo.cachevfs`).
+
+    Entries past their TTL are kept, since they are still used when the
+    forge cannot be reached, but entries older than `maxage` seconds are
+    removed when results are written, at most every `PRUNE_INTERVAL`
+    seconds.
+    """
+
+    def __init__(self, vfs, endpoint, maxage=MAXAGE):
+        self.vfs = vfs
+        self.endpoint = endpoint
+        self.maxage = maxage
+
+    def _path(self, query, args):
+        key = json.dumps([self.endpoint, query, args], sort_keys=True)
+        return '%s/%s' % (CACHEDIR, hashlib.sha1(key).hexdigest())
+
+    def get(self, query, args=None):
+        """Return a (data, age in seconds) tuple for the cached result of
+        given query, or (None, None) if there is no such entry"""
+        try:
+            content = self.vfs.tryread(self._path(query, args))
+            entry = json.loads(content) if content else None
+        except ValueError:
+            entry = None
+        if not entry:
+            return None, None
+        return entry['data'], max(time.time() - entry['time'], 0)
+
+    def set(self, query, args, data):
+        entry = {'time': time.time(), 'endpoint': self.endpoint,
+                 'query': query, 'args': args, 'data': data}
+        with self.vfs(self._path(query, args), 'wb', atomictemp=True) as f:
+            f.write(json.dumps(entry))
+        self.prune()
+
+    def prune(self):
+        """Remove entries older than `maxage`, unless it has been done less
+        than `PRUNE_INTERVAL` seconds ago"""
+        now = time.time()
+        stamp = '%s/%s' % (CACHEDIR, PRUNE_STAMP)
+        try:
+            if now - self.vfs.stat(stamp).st_mtime < PRUNE_INTERVAL:
+                return
+        except OSError:
+            pass
+        self.vfs.write(stamp, '')
+        for name in self.vfs.listdir(CACHEDIR):
+            path = '%s/%s' % (CACHEDIR, name)
+            try:
+                if (name != PRUNE_STAMP
+                        and now - self.vfs.stat(path).st_mtime > self.maxage):
+                    self.vfs.unlink(path)
+            except OSError:
+                # removed by another process
+                pass
+
+    def clear(self):
+        self.vfs.rmtree(CACHEDIR, ignore_errors=True)
+
+
+def getcache(repo, opts=None):
+    """Return the forge cache of `repo` for the configured endpoint"""
+    vfs = getattr(repo, 'cachevfs', None)
+    if vfs is None:
+        # Mercurial < 4.4
+        vfs = scmutil.vfs(repo.vfs.join('cache'))
+    endpoint = getcwcliopt('endpoint', repo.ui, opts, default=URL)
+    return ForgeCache(vfs, endpoint,
+                      repo.ui.configint('jpl', 'cache-max-age', MAXAGE))
+
+
+def _fetch(ui, opts, query, args):
+    with build_proxy(ui, opts) as client:
+        if args:
+            return client.execute(query, args, readonly=True)
+        return client.rql(query)
+
+
+def cachedquery(repo, query, args=None, opts=None):
+    """Execute a read-only RQL query, going through the forge cache.
+
+    Cached results younger than `jpl.cache-ttl` seconds are returned without
+    contacting the forge. If `jpl.cache-stale` is set, expired results are
+    returned as well while being refreshed in a background thread.
+    When offline, cached results are returned whatever their age.
+
+    With a `jpl.cache-ttl` of 0, the cache is neither read nor written.
+    """
+    ui = repo.ui
+    ttl = ui.configint('jpl', 'cache-ttl', TTL)
+    if ttl <= 0:
+        if isoffline(ui, opts):
+            return None
+        return _fetch(ui, opts, query, args)
+    cache = getcache(repo, opts)
+    data, age = cache.get(query, args)
+    trace = gettrace(ui, opts)
+    if isoffline(ui, opts) or (data is not None and age < ttl):
+        if trace is not None:
+            trace.record('cache', query, cache='hit' if data is not None
+                         else 'miss')
+        return data
+
+    def refresh():
+        result = _fetch(ui, opts, query, args)
+        # errors are reported as strings by the proxy, do not cache them
+        if isinstance(result, list):
+            cache.set(query, args, result)
+        return result
+
+    if trace is not None:
+        trace.record('cache', query,
+                     cache='miss' if data is None else 'stale')
+    if data is not None and ui.configbool('jpl', 'cache-stale', False):
+        thread = threading.Thread(target=refresh)
+        thread.start()
+        return data
+    result = refresh()
+    if result is None:
+        # forge is unreachable, better stale data than nothing
+        result = data
+    return result
@@ -1,13 +1,37 @@
 #!/usr/bin/python
 # -*- coding: utf-8
 
+import functools
+import sys
+import threading
+import time
+import types
 from contextlib import contextmanager
 from mercurial.i18n import _
-from requests import ConnectionError, HTTPError
+import requests
+from requests import ConnectionError, HTTPError, Timeout
+from requests.adapters import HTTPAdapter
 
 from cwclientlib import cwproxy, cwproxy_for
 
+from .trace import gettrace
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
 URL = 'https://www.cubicweb.org/'
+CHUNKSIZE = 100
+POOLSIZE = 4
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+CONCURRENCY = 4
+
+# HTTP sessions shared by all proxies of the process, by base url
+_SESSIONS = {}
 
 
 def wraprql(meth):
@@ -25,13 +49,93 @@ def wraprql(meth):
     return wrapper
 
 
+def getsession(url, poolsize=POOLSIZE):
+    """Return the process-wide HTTP session used to talk to `url`, so that
+    connections are kept alive and reused by every proxy"""
+    if url not in _SESSIONS:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _SESSIONS[url] = session
+    return _SESSIONS[url]
+
+
+class _Transport(object):
+    """Stand-in for the `requests` module in the namespace of cwproxy.CWProxy
+    methods, posting requests with given `send` function"""
+
+    def __init__(self, send):
+        self.post = send
+
+
 class JplProxy(cwproxy.CWProxy):
-    rql = wraprql(cwproxy.CWProxy.rql)
-    rqlio = wraprql(cwproxy.CWProxy.rqlio)
+    """cwproxy sending its requests through a pooled session (see
+    `getsession`), with timeouts and retries of read queries"""
+    session = None
+    timeout = None
+    chunksize = CHUNKSIZE
+    retries = 0
+    backoff = RETRY_BACKOFF
+    # `RemoteTrace` recording requests, if any
+    trace = None
+
+    def _send(self, kind, query, url, **params):
+        # low-level send of requests built by cwproxy.CWProxy methods
+        session = self.session or requests
+        params.setdefault('timeout', self.timeout)
+        if self.trace is not None:
+            return self.trace.timed(kind, query, session.post, url, **params)
+        return session.post(url, **params)
+
+    def _cwcall(self, meth, kind, query, *args, **kwargs):
+        """Call `meth`, a method of cwproxy.CWProxy, its requests being sent
+        by `_send` (as `kind` requests for `query`) instead of the
+        `requests` module"""
+        func = getattr(meth, '__func__', meth)
+        transport = _Transport(functools.partial(self._send, kind, query))
+        func = types.FunctionType(
+            func.__code__, dict(func.__globals__, requests=transport),
+            func.__name__, func.__defaults__, func.__closure__)
+        return func(self, *args, **kwargs)
 
-    def execute(self, rql, args=None):
+    def _rql(self, rql, path='view', **data):
+        # retried since it is a read-only query
+        return self._retried(lambda: self._cwcall(
+            cwproxy.CWProxy.rql, 'rql', rql, rql, path, **data))
+
+    def _rqlio(self, queries, readonly=False):
+        # only retried if queries are known not to write
+        queries = list(queries)
+
+        def send():
+            return self._cwcall(cwproxy.CWProxy.rqlio, 'rqlio',
+                                [rql for rql, args in queries], queries)
+        return self._retried(send) if readonly else send()
+
+    def _retried(self, send):
+        """Return the reply of `send()`, sending a read-only request, which
+        is sent again up to `retries` times on connection errors, timeouts
+        and gateway errors"""
+        delay = self.backoff
+        for attempt in range(self.retries, -1, -1):
+            try:
+                reply = send()
+            except (ConnectionError, Timeout):
+                if not attempt:
+                    raise
+            else:
+                if not attempt or reply.status_code not in (502, 503, 504):
+                    return reply
+            time.sleep(delay)
+            delay *= 2
+
+    rql = wraprql(_rql)
+    rqlio = wraprql(_rqlio)
+
+    def execute(self, rql, args=None, readonly=False):
         # reimplemented since rqlio is wrapped
-        result = self.rqlio([(rql, args)])
+        result = self.rqlio([(rql, args)], readonly=readonly)
         if isinstance(result, list):
             result = result[0]
         return result
@@ -49,13 +153,141 @@ def getcwcliopt(name, ui, opts, default=None, isbool=False):
     return value
 
 
+def getintopt(name, ui, opts, default):
+    try:
+        return int(getcwcliopt(name, ui, opts, default=default))
+    except ValueError:
+        return default
+
+
+def isoffline(ui, opts=None):
+    """Return True if the forge must not be contacted"""
+    return getcwcliopt('offline', ui, opts, default=False, isbool=True)
+
+
+def getchunksize(ui, opts=None):
+    """Return the maximum number of changesets to send in a single query"""
+    return max(getintopt('chunk-size', ui, opts, CHUNKSIZE), 1)
+
+
+def chunked(iterable, size):
+    """Yield lists of at most `size` items from `iterable`"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def inlist(revs):
+    """Return the RQL list of given changesets (short hex)"""
+    return ','.join('%r' % str(rev) for rev in revs)
+
+
+def chunked_rql(client, rql, revs):
+    """Execute `rql` for every changeset of `revs`, its `{revs}` field being
+    replaced by lists of at most `client.chunksize` changesets.
+
+    Chunks are queried through the RQL view, as `client.rql` does, from at
+    most CONCURRENCY threads; rows of their result sets are returned in
+    chunk order with duplicates removed, or the error message of the first
+    failing chunk.
+    """
+    queries = [rql.format(revs=inlist(chunk))
+               for chunk in chunked(revs, client.chunksize)]
+    rsets = [None] * len(queries)
+    for idx, rset in imap_unordered(
+            lambda idx: client.rql(queries[idx], vid='jsonexport'),
+            range(len(queries))):
+        rsets[idx] = rset
+    rows, seen = [], set()
+    for rset in rsets:
+        if not isinstance(rset, list):
+            # error message
+            return rset
+        for row in rset:
+            if tuple(row) not in seen:
+                seen.add(tuple(row))
+                rows.append(row)
+    return rows
+
+
+def imap_unordered(func, items, workers=CONCURRENCY):
+    """Call `func` on every item from at most `workers` threads, yielding
+    (item, result) pairs as soon as each call returns.
+
+    Exceptions raised by `func` are raised again in the calling thread.
+    Threads are joined before the generator returns, is closed or raises.
+    """
+    items = list(items)
+    todo, done = Queue.Queue(), Queue.Queue()
+    for item in items:
+        todo.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception:
+                done.put((item, None, sys.exc_info()[1]))
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max(workers, 1), len(items)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(len(items)):
+            item, result, exc = done.get()
+            if exc is not None:
+                raise exc
+            yield item, result
+    finally:
+        # when stopped early, let workers end after their current call
+        while True:
+            try:
+                todo.get_nowait()
+            except Queue.Empty:
+                break
+        for thread in threads:
+            thread.join()
+
+
 @contextmanager
 def build_proxy(ui, opts=None):
-    """Build a cwproxy"""
+    """Build a cwproxy
+
+    Queries about many changesets are split by `chunk-size` changesets (see
+    `chunked_rql`). Proxies of a same endpoint share a pool of `pool-size`
+    keep-alive connections. Read queries are retried `retries` times, waiting
+    `retry-backoff` seconds, doubled after each attempt. Requests are
+    recorded if remote requests are profiled (see `gettrace`).
+    """
     try:
         endpoint = getcwcliopt('endpoint', ui, opts, default=URL)
-        yield cwproxy_for(endpoint, proxycls=JplProxy)
-    except ConnectionError as exc:
+        client = cwproxy_for(endpoint, proxycls=JplProxy)
+        client.session = getsession(client.build_url(''),
+                                    getintopt('pool-size', ui, opts,
+                                              POOLSIZE))
+        client.timeout = (
+            getintopt('connect-timeout', ui, opts, CONNECT_TIMEOUT),
+            getintopt('read-timeout', ui, opts, READ_TIMEOUT))
+        client.chunksize = getchunksize(ui, opts)
+        client.trace = gettrace(ui, opts)
+        client.retries = getintopt('retries', ui, opts, RETRIES)
+        try:
+            client.backoff = float(getcwcliopt('retry-backoff', ui, opts,
+                                               default=RETRY_BACKOFF))
+        except ValueError:
+            pass
+        yield client
+    except (ConnectionError, Timeout) as exc:
         if ui.tracebackflag:
             raise
         try:
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+
+import json
+from contextlib import contextmanager
+
+from cwclientlib.cwproxy import RemoteValidationError
+from mercurial import util
+from mercurial.i18n import _
+from requests import ConnectionError, Timeout
+
+from .cache import getcache
+from .jplproxy import build_proxy, isoffline
+from .review import (ask_review_queries, acknowledge_queries, assign_queries,
+                     add_reviewer_queries)
+
+JOURNAL = 'jpl-journal'
+
+# write operations that can be queued while offline, each one building the
+# list of (rql, args) queries to send for (client, revs, arg)
+OPERATIONS = {
+    'ask-review': lambda client, revs, arg: ask_review_queries(client, revs),
+    'acknowledge': lambda client, revs, arg: acknowledge_queries(client, revs,
+                                                                 arg),
+    'assign': lambda client, revs, arg: assign_queries(revs, arg,
+                                                       client.chunksize),
+    'add-reviewer': lambda client, revs, arg: add_reviewer_queries(
+        revs, arg, client.chunksize),
+}
+
+
+def formatage(age):
+    """Return a human readable version of `age` (in seconds)"""
+    for unit, seconds in (('d', 86400), ('h', 3600), ('m', 60)):
+        if age >= seconds:
+            return '%d%s' % (age // seconds, unit)
+    return '%ds' % age
+
+
+class Journal(object):
+    """Write operations queued while offline, stored in the `jpl-journal`
+    file of given vfs (typically `repo.vfs`)."""
+
+    def __init__(self, vfs):
+        self.vfs = vfs
+
+    def read(self):
+        data = self.vfs.tryread(JOURNAL)
+        return json.loads(data) if data else []
+
+    def write(self, entries):
+        if not entries:
+            self.clear()
+            return
+        with self.vfs(JOURNAL, 'wb', atomictemp=True) as f:
+            f.write(json.dumps(entries))
+
+    def append(self, op, revs, arg=None):
+        entries = self.read()
+        entries.append({'op': op, 'revs': list(revs), 'arg': arg})
+        self.write(entries)
+
+    def clear(self):
+        if self.vfs.exists(JOURNAL):
+            self.vfs.unlink(JOURNAL)
+
+
+def describe(entry):
+    """Return a human readable description of a journal entry"""
+    desc = '%s %s' % (entry['op'], ','.join(entry['revs']))
+    if entry['arg']:
+        desc += ' (%s)' % entry['arg']
+    return desc
+
+
+class CachedProxy(object):
+    """Wrap a forge client so that read queries results are stored in the
+    forge cache, and served from it when offline or when the forge is
+    unreachable.
+
+    `age` is the age (in seconds) of the oldest cached result used, None if
+    every result came from the forge.
+    """
+
+    def __init__(self, client, cache, offline=False):
+        self.client = client
+        self.cache = cache
+        self.offline = offline
+        self.age = None
+
+    def __getattr__(self, attr):
+        return getattr(self.client, attr)
+
+    def _record(self, method, query, cache):
+        trace = getattr(self.client, 'trace', None)
+        if trace is not None:
+            trace.record('cache', [method, query], cache=cache)
+
+    def _query(self, method, query, args, **kwargs):
+        if not self.offline:
+            # `kwargs` are options of the call, not part of the cache key
+            callargs = dict(args, **kwargs)
+            try:
+                data = getattr(self.client, method)(query, **callargs)
+            except (ConnectionError, Timeout):
+                data = None
+            # errors are reported as strings by the proxy, do not cache them
+            if isinstance(data, list):
+                self._record(method, query, 'miss')
+                self.cache.set([method, query], args, data)
+                return data
+        data, age = self.cache.get([method, query], args)
+        if data is None:
+            raise util.Abort(_('forge is not available and no cached result '
+                               'found for this query'))
+        self._record(method, query, 'hit')
+        self.age = age if self.age is None else max(self.age, age)
+        return data
+
+    def rql(self, query, **kwargs):
+        return self._query('rql', query, kwargs)
+
+    def rqlio(self, queries, readonly=False):
+        return self._query('rqlio', queries, {}, readonly=readonly)
+
+    def execute(self, rql, args=None, readonly=False):
+        result = self.rqlio([(rql, args)], readonly=readonly)
+        if isinstance(result, list):
+            result = result[0]
+        return result
+
+
+def send(client, op, revs, arg=None):
+    """Send write operation `op` on patches of `revs` to the forge, return
+    None if it succeeded, the reason why the forge rejected it otherwise.
+
+    Raise ConnectionError or Timeout if the forge cannot be reached.
+    """
+    queries = OPERATIONS[op](client, revs, arg)
+    if not queries:
+        return None
+    try:
+        result = client.rqlio(queries)
+    except RemoteValidationError as exc:
+        return str(exc)
+    if isinstance(result, list):
+        return None
+    return result or _('invalid reply')
+
+
+def replay(ui, client, journal):
+    """Send queued operations of `journal`, one batch per operation.
+
+    Operations rejected by the forge are reported and dropped; if the forge
+    cannot be reached, remaining operations are kept. Return True if every
+    queued operation has been handled.
+    """
+    entries = journal.read()
+    sent = 0
+    while entries:
+        entry = entries[0]
+        try:
+            error = send(client, entry['op'], entry['revs'], entry['arg'])
+        except (ConnectionError, Timeout):
+            ui.warn(_('forge unreachable, %d queued operation(s) not '
+                      'sent\n') % len(entries))
+            return False
+        if error is None:
+            sent += 1
+        else:
+            ui.warn(_('queued %s rejected by the forge, dropped: %s\n')
+                    % (describe(entry), error))
+        entries.pop(0)
+        journal.write(entries)
+    if sent:
+        ui.status(_('replayed %d queued operation(s)\n') % sent)
+    return True
+
+
+def run_or_queue(ui, repo, opts, op, revs, arg=None):
+    """Run write operation `op` on patches of `revs`, or queue it in the
+    journal when offline or when the forge cannot be reached. Return True
+    if the operation has been sent and accepted by the forge."""
+    revs = list(revs)
+    journal = Journal(repo.vfs)
+    if isoffline(ui, opts):
+        journal.append(op, revs, arg)
+        ui.status(_('offline: %s queued\n') % op)
+        return False
+    with build_proxy(ui, opts) as client:
+        # keep operations in order: queue this one behind unsent ones
+        if replay(ui, client, journal):
+            try:
+                error = send(client, op, revs, arg)
+            except (ConnectionError, Timeout) as exc:
+                ui.warn(_('forge unreachable: %s\n') % exc)
+            else:
+                if error is None:
+                    return True
+                ui.warn(_('%s rejected by the forge: %s\n') % (op, error))
+                return False
+    journal.append(op, revs, arg)
+    ui.status(_('%s queued\n') % op)
+    return False
+
+
+@contextmanager
+def forge_proxy(repo, opts=None):
+    """Build a forge client for read-only commands, see `CachedProxy`"""
+    ui = repo.ui
+    offline = isoffline(ui, opts)
+    with build_proxy(ui, opts) as client:
+        if not offline:
+            journal = Journal(repo.vfs)
+            if journal.read():
+                replay(ui, client, journal)
+        proxy = CachedProxy(client, getcache(repo, opts), offline)
+        yield proxy
+        if proxy.age is not None:
+            ui.status(_('(cached results, %s old)\n') % formatage(proxy.age))
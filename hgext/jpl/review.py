@@ -3,27 +3,37 @@
 
 from cwclientlib import builders
 
+from .jplproxy import chunked, chunked_rql, inlist, CHUNKSIZE
 
-def ask_review(client, revs):
-    eids = client.rql(
+
+def ask_review_queries(client, revs):
+    eids = chunked_rql(
+        client,
         '''Any P WHERE P patch_revision R, R changeset IN ({revs}),
                        P in_state S, S name 'in-progress'
-        '''.format(revs=','.join('%r' % rev for rev in revs)))
-    queries = [builders.build_trinfo(eid[0], 'ask review') for eid in eids]
-    return client.rqlio(queries)
+        ''', revs)
+    return [builders.build_trinfo(eid[0], 'ask review') for eid in eids]
 
 
-def acknowledge(client, revs, msg=None):
-    """Set patch reviewed OK
-    """
-    eids = client.rql(
+def ask_review(client, revs):
+    return client.rqlio(ask_review_queries(client, revs))
+
+
+def acknowledge_queries(client, revs, msg=None):
+    eids = chunked_rql(
+        client,
         '''Any P WHERE P patch_revision R, R changeset IN ({revs}),
                        P in_state S,
                        S name IN ('pending-review', 'in-progress')
-        '''.format(revs=','.join('%r' % rev for rev in revs)))
-    queries = [builders.build_trinfo(eid[0], 'accept', comment=msg)
-               for eid in eids]
-    return client.rqlio(queries)
+        ''', revs)
+    return [builders.build_trinfo(eid[0], 'accept', comment=msg)
+            for eid in eids]
+
+
+def acknowledge(client, revs, msg=None):
+    """Set patch reviewed OK
+    """
+    return client.rqlio(acknowledge_queries(client, revs, msg))
 
 
 def show_review(client, revs, committer=None):
@@ -39,42 +49,67 @@ WHERE
   P patch_name PN,
   P patch_reviewer U?,
   U login L'''
-    fmt = {'revs': ','.join('%r' % rev for rev in revs)}
     if committer:
         query += ', P patch_committer PC, PC login "{committer}"'
-        fmt['committer'] = committer
-    query = query.format(**fmt)
-    return client.rql(query)
+        query = query.format(revs='{revs}', committer=committer)
+    rows = chunked_rql(client, query, revs)
+    if not isinstance(rows, list):
+        return rows
+    # merge changesets of patches found in several chunks
+    patches, result = {}, []
+    for row in rows:
+        if row[1] in patches:
+            patch = patches[row[1]]
+            patch[2] = ', '.join((patch[2], row[2]))
+        else:
+            patches[row[1]] = list(row)
+            result.append(patches[row[1]])
+    return result
 
 
-def assign(client, revs, committer):
-    """Assign patches corresponding to specified revisions to specified committer.
-    """
-    revstr = ','.join('%r' % rev for rev in revs)
+def _rows(rsets):
+    """Return rows of all result sets of an rqlio batch, as the result set
+    of a single query, or the error message of the forge"""
+    if not isinstance(rsets, list):
+        return rsets
+    return [row for rset in rsets for row in rset]
+
+
+def _revsconstraint(revs):
+    revstr = inlist(revs)
     if revstr.count(',') > 0:
-        revq = 'IN ({revs})'.format(revs=revstr)
-    else:
-        revq = revstr
-    query = '''SET P patch_committer U WHERE P patch_revision R,
+        return 'IN ({revs})'.format(revs=revstr)
+    return revstr
+
+
+def assign_queries(revs, committer, chunksize=CHUNKSIZE):
+    return [('''SET P patch_committer U WHERE P patch_revision R,
                                              R changeset {revq},
                                              U login '{login}'
-            '''.format(revq=revq, login=committer)
-    return client.rqlio([(query, {})])[0]
+            '''.format(revq=_revsconstraint(chunk), login=committer), {})
+            for chunk in chunked(revs, chunksize)]
 
 
-def add_reviewer(client, revs, reviewer):
-    """Add a reviewer to patches corresponding to specified revisions.
+def assign(client, revs, committer):
+    """Assign patches corresponding to specified revisions to specified committer.
     """
-    revstr = ','.join('%r' % rev for rev in revs)
-    if revstr.count(',') > 0:
-        revq = 'IN ({revs})'.format(revs=revstr)
-    else:
-        revq = revstr
-    query = '''SET P patch_reviewer U WHERE P patch_revision R,
+    return _rows(client.rqlio(assign_queries(revs, committer,
+                                             client.chunksize)))
+
+
+def add_reviewer_queries(revs, reviewer, chunksize=CHUNKSIZE):
+    return [('''SET P patch_reviewer U WHERE P patch_revision R,
                                             R changeset {revq},
                                             U login '{login}'
-            '''.format(revq=revq, login=reviewer)
-    return client.rqlio([(query, {})])[0]
+            '''.format(revq=_revsconstraint(chunk), login=reviewer), {})
+            for chunk in chunked(revs, chunksize)]
+
+
+def add_reviewer(client, revs, reviewer):
+    """Add a reviewer to patches corresponding to specified revisions.
+    """
+    return _rows(client.rqlio(add_reviewer_queries(revs, reviewer,
+                                                   client.chunksize)))
 
 
 def sudo_make_me_a_ticket(client, repo, rev, version=None, kind=None):
@@ -4,37 +4,36 @@
 import itertools
 import sys
 
-from .jplproxy import build_proxy, URL
+from .jplproxy import build_proxy, chunked_rql, URL
 
 ENCODING = sys.stdout.encoding or 'ascii'
 INDENT = '  '
 
 PATCH_RQL = """
-rql:
 DISTINCT
-Any P,PN,SN,R,T,TTITLE,TDESC,TSN
+Any P,PN,SN,R,T,TTITLE,TDESC,TSN,RC
 ORDERBY R
-WITH P,PN,SN,R,T,TTITLE,TDESC,TSN
+WITH P,PN,SN,R,T,TTITLE,TDESC,TSN,RC
 BEING ({unions})
 """
 
 UNIONS = ["""
-(Any P,PN,SN,R,T,TTITLE,TDESC,TSN
- WHERE P patch_revision R, R changeset IN ({revs}),
+(Any P,PN,SN,R,T,TTITLE,TDESC,TSN,RC
+ WHERE P patch_revision R, R changeset IN ({revs}), R changeset RC,
        P in_state S, P patch_name PN,
        S name SN, P has_activity T, T in_state TS, T title TTITLE,
        T description TDESC?, TS name TSN
        {taskstate})
 """, """
-(Any P,PN,SN,R,T,TTITLE,TDESC,TSN ORDERBY R
- WHERE P patch_revision R, R changeset IN ({revs}),
+(Any P,PN,SN,R,T,TTITLE,TDESC,TSN,RC ORDERBY R
+ WHERE P patch_revision R, R changeset IN ({revs}), R changeset RC,
        P in_state S, P patch_name PN,
        S name SN, X has_activity T, X point_of RX, P patch_revision RX,
        T in_state TS, T title TTITLE, T description TDESC?, TS name TSN
        {taskstate})
 """, """
-(Any P,PN,SN,R,NULL,NULL,NULL,NULL
- WHERE P patch_revision R, R changeset IN ({revs}),
+(Any P,PN,SN,R,NULL,NULL,NULL,NULL,RC
+ WHERE P patch_revision R, R changeset IN ({revs}), R changeset RC,
        P in_state S, P patch_name PN,
        S name SN, NOT EXISTS(P has_activity T),
        NOT EXISTS(P patch_revision RX, X point_of RX, X has_activity T))
@@ -74,22 +73,41 @@ def print_task(ui, reveid, ttitle, tstate, tdesc, url):
     ui.write('\n')
 
 
-def print_tasks(client, ui, revs, showall=False):
-    """A python script that displays tasks requested by reviewwers on a patch
-    on www.cubicweb.org"""
-    revs = ','.join('%r' % rev for rev in revs)
+def fetch_tasks(client, revs, showall=False):
+    """Return the task rows of patches linked to given changesets (short hex)
+
+    Each row is a (peid, pname, pstate, reveid, teid, ttitle, tdesc, tstate,
+    changeset) tuple, rows of a same patch being kept together.
+    """
     if showall:
         rql = PATCH_RQL.format(unions='UNION'.join(UNIONS))
         taskstate = ''
     else:
         rql = PATCH_RQL.format(unions='UNION'.join(UNIONS[:2]))
         taskstate = TASKNOTDONE_RQL
-
-    patchesdata = client.rql(rql.format(revs=revs, taskstate=taskstate),
-                             vid='jsonexport')
-    if not patchesdata:
-        raise ValueError("no tasks found for revisions: %r" % ','.join(revs))
-
+    rows = chunked_rql(client, rql.format(revs='{revs}', taskstate=taskstate),
+                       revs)
+    if not isinstance(rows, list):
+        return rows
+    return sorted(rows, key=lambda row: (row[0], row[3]))
+
+
+def prefetch_tasks(client, revs, showall=False):
+    """Fetch tasks for given changesets (short hex) and return a
+    {changeset: rows} dict with an entry for every requested changeset, or
+    the error message of the forge."""
+    revs = list(revs)
+    rows = fetch_tasks(client, revs, showall)
+    if rows is not None and not isinstance(rows, list):
+        return rows
+    result = dict((rev, []) for rev in revs)
+    for row in rows or ():
+        result.setdefault(row[-1], []).append(row)
+    return result
+
+
+def write_tasks(client, ui, patchesdata):
+    """Display task rows as returned by `fetch_tasks`"""
     patchesdata = itertools.groupby(patchesdata, lambda x: x[:3])
     for (peid, pname, pstate), patchdata in patchesdata:
         msg = '{name} {url} ({state})\n\n'.format(
@@ -97,7 +115,7 @@ def print_tasks(client, ui, revs, showall=False):
         ui.write(msg, label='jpl.tasks.patch')
         teids = set()
         for (peid, pname, pstate, reveid,
-             teid, ttitle, tdesc, tstate) in patchdata:
+             teid, ttitle, tdesc, tstate, cset) in patchdata:
             if teid is None or teid in teids:
                 continue
             teids.add(teid)
@@ -105,6 +123,16 @@ def print_tasks(client, ui, revs, showall=False):
                        client.build_url(str(teid)))
 
 
+def print_tasks(client, ui, revs, showall=False):
+    """A python script that displays tasks requested by reviewwers on a patch
+    on www.cubicweb.org"""
+    revs = list(revs)
+    patchesdata = fetch_tasks(client, revs, showall)
+    if not patchesdata:
+        raise ValueError("no tasks found for revisions: %r" % ','.join(revs))
+    write_tasks(client, ui, patchesdata)
+
+
 if __name__ == '__main__':
     import sys
     import argparse
@@ -146,10 +174,16 @@ if __name__ == '__main__':
 
     # output
     class output(object):
+        # used by build_proxy on connection errors
+        tracebackflag = False
+
         def write(self, msg, label=None):
             sys.stdout.write(colortable.get(label, ''))
             sys.stdout.write(msg)
             sys.stdout.write(colortable.get('reset', ''))
+
+        def warn(self, msg):
+            sys.stderr.write(msg)
     ui = output()
     with build_proxy(ui, opts) as client:
         print_tasks(client, ui, revs, opts)
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+
+import atexit
+import os
+
+from mercurial import extensions, util
+
+try:
+    from hgext.remotetrace import RemoteTrace
+except ImportError:
+    # extension loaded from a source tree rather than installed: load the
+    # module the way Mercurial loads extensions given by path
+    RemoteTrace = extensions.loadpath(
+        os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'remotetrace.py'),
+        'hgext.remotetrace').RemoteTrace
+
+
+def gettrace(ui, opts=None):
+    """Return the trace of the command running with `ui` if remote requests
+    are profiled (`--profile-remote` option, `jpl.trace` or `jpl.trace-file`
+    config entries), None otherwise.
+
+    The trace is reported when the command ends: as a summary table on
+    stderr, or as JSON in `jpl.trace-file` if set.
+    """
+    trace = getattr(ui, '_jpltrace', None)
+    if trace is not None:
+        return trace
+    # ui may be a bare output object (see tasks.py command line interface)
+    hasconfig = getattr(ui, 'config', None) is not None
+    path = ui.config('jpl', 'trace-file') if hasconfig else None
+    if not (path or (hasconfig and ui.configbool('jpl', 'trace', False))
+            or (opts and opts.get('profile_remote'))):
+        return None
+    ui._jpltrace = trace = RemoteTrace()
+
+    def report():
+        if path:
+            trace.dump(path)
+        else:
+            trace.write(ui)
+
+    if util.safehasattr(ui, 'atexit'):
+        ui.atexit(report)
+    else:
+        atexit.register(report)
+    return trace
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+
+# Record of remote requests shared by the jpl and jenkins extensions, on
+# Python 2 and 3. Not an extension itself.
+
+import json
+import threading
+import time
+
+
+class RemoteTrace(object):
+    """Record of the requests sent to a remote server by a command, with
+    their latency, the size of their reply and, for lookups in a local
+    cache or store, whether the result was found (`hit`), found expired
+    (`stale`) or not found (`miss`).
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.records = []
+        # requests may be sent from several threads
+        self._lock = threading.Lock()
+
+    def record(self, kind, query, latency=0., size=0, cache=None,
+               status=None):
+        entry = {'kind': kind, 'query': query, 'latency': latency,
+                 'size': size, 'cache': cache, 'status': status,
+                 'time': time.time() - self.start}
+        with self._lock:
+            self.records.append(entry)
+
+    def timed(self, kind, query, func, *args, **kwargs):
+        """Call `func` and record it as a request returning a
+        `requests.Response`"""
+        start = time.time()
+        reply = None
+        try:
+            reply = func(*args, **kwargs)
+            return reply
+        finally:
+            self.record(kind, query, time.time() - start,
+                        len(reply.content) if reply is not None else 0,
+                        status=reply.status_code if reply is not None
+                        else None)
+
+    def hook(self, kind):
+        """Return a `requests` response hook recording requests as `kind`
+        requests"""
+        def hook(response, *args, **kwargs):
+            self.record(kind, response.request.url,
+                        response.elapsed.total_seconds(),
+                        len(response.content), status=response.status_code)
+        return hook
+
+    def summary(self):
+        """Return (kind, count, hits, misses, total latency, max latency,
+        size) rows, one per kind of request"""
+        rows = {}
+        for entry in self.records:
+            row = rows.setdefault(entry['kind'],
+                                  [entry['kind'], 0, 0, 0, 0., 0., 0])
+            row[1] += 1
+            if entry['cache'] == 'hit':
+                row[2] += 1
+            elif entry['cache'] is not None:
+                row[3] += 1
+            row[4] += entry['latency']
+            row[5] = max(row[5], entry['latency'])
+            row[6] += entry['size']
+        return [tuple(row) for row in sorted(rows.values())]
+
+    def write(self, ui):
+        """Write the summary as a table on stderr of `ui`"""
+        lines = ['%-8s %8s %6s %6s %10s %10s %10s\n'
+                 % ('request', 'count', 'hits', 'misses', 'total (s)',
+                    'max (s)', 'bytes')]
+        lines.extend('%-8s %8d %6d %6d %10.3f %10.3f %10d\n' % row
+                     for row in self.summary())
+        for line in lines:
+            if not isinstance(line, bytes):
+                # Mercurial on Python 3 only writes bytes
+                line = line.encode('utf-8')
+            ui.write_err(line)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'start': self.start, 'records': self.records}, f,
+                      indent=1)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8
+"""Tests of the binary format of the Jenkins store"""
+
+import unittest
+
+from hgext.jenkins import nodeindex, packbinstore, unpackbinstore
+
+
+def build(number, status='SUCCESS', building=False, url=None):
+    return {'number': number, 'status': status, 'building': building,
+            'url': url or 'https://ci.example.org/job/tests/%d/' % number}
+
+
+CACHE = {
+    'tip': 42,
+    'lastbuild': {'tests': 3, 'docs': 1},
+    'jobs': {
+        'tests': {
+            'ff' * 20: build(1, 'FAILURE'),
+            '00' * 20: build(2),
+            '7a' * 20: build(3, None, building=True),
+        },
+        'docs': {
+            '7a' * 20: build(1, url='https://docs.example.org/latest'),
+        },
+    },
+}
+
+
+class BinaryStoreTC(unittest.TestCase):
+
+    def test_roundtrip(self):
+        cache = unpackbinstore(packbinstore(CACHE))
+        self.assertEqual(cache['tip'], 42)
+        self.assertEqual(cache['lastbuild'], CACHE['lastbuild'])
+        self.assertEqual(sorted(cache['jobs']), ['docs', 'tests'])
+        for name, jobcache in CACHE['jobs'].items():
+            self.assertEqual(dict(cache['jobs'][name]), jobcache)
+
+    def test_empty(self):
+        cache = unpackbinstore(packbinstore({'tip': 0, 'lastbuild': {},
+                                             'jobs': {'tests': {}}}))
+        self.assertEqual(len(cache['jobs']['tests']), 0)
+        self.assertNotIn('00' * 20, cache['jobs']['tests'])
+
+    def test_lookup(self):
+        index = unpackbinstore(packbinstore(CACHE))['jobs']['tests']
+        self.assertIsInstance(index, nodeindex)
+        self.assertEqual(len(index), 3)
+        # records are sorted by node
+        self.assertEqual(list(index), ['00' * 20, '7a' * 20, 'ff' * 20])
+        self.assertEqual(index['7a' * 20], build(3, None, building=True))
+        self.assertIn('ff' * 20, index)
+        for missing in ('01' * 20, '7a' * 19, 'not hex', ''):
+            self.assertNotIn(missing, index)
+        self.assertRaises(KeyError, index.__getitem__, '01' * 20)
+
+    def test_bad_magic(self):
+        data = b'XXXX' + packbinstore(CACHE)[4:]
+        self.assertRaises(ValueError, unpackbinstore, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8
+"""Tests of the bin/jobtest test runner"""
+
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+jobtest = imp.load_source(
+    'jobtest', os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'bin', 'jobtest'))
+
+
+class ResourcePoolTC(unittest.TestCase):
+
+    def setUp(self):
+        self.load = 0.
+        self.available = None
+        self._getloadavg = os.getloadavg
+        self._available_memory = jobtest.available_memory
+        os.getloadavg = lambda: (self.load, self.load, self.load)
+        jobtest.available_memory = lambda: self.available
+
+    def tearDown(self):
+        os.getloadavg = self._getloadavg
+        jobtest.available_memory = self._available_memory
+
+    def pool(self, running, workers=4, memory=None, reserved=0):
+        pool = jobtest.ResourcePool(workers, memory)
+        pool.running, pool.reserved = running, reserved
+        return pool
+
+    def test_workers(self):
+        self.assertTrue(self.pool(3).admissible(1))
+        self.assertFalse(self.pool(4).admissible(1))
+
+    def test_first_always(self):
+        self.load, self.available = 100., 0
+        self.assertTrue(self.pool(0, memory=1).admissible(10))
+
+    def test_own_load(self):
+        # the load of our own tests, even of those that just ended, does not
+        # hold new tests back
+        self.load = 3.
+        self.assertTrue(self.pool(3).admissible(1))
+        self.load = 4.
+        self.assertTrue(self.pool(1).admissible(1))
+
+    def test_external_load(self):
+        # other processes keep every CPU busy
+        self.load = 6.
+        self.assertFalse(self.pool(2, workers=4).admissible(1))
+        self.load = 5.9
+        self.assertTrue(self.pool(2, workers=4).admissible(1))
+
+    def test_memory(self):
+        self.assertTrue(self.pool(1, memory=100, reserved=60).admissible(40))
+        self.assertFalse(self.pool(1, memory=100, reserved=60).admissible(41))
+        self.available = 30
+        self.assertFalse(self.pool(1).admissible(40))
+        self.assertTrue(self.pool(1).admissible(30))
+
+
+class ShardsTC(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = None
+        self._collect_ids = jobtest.collect_ids
+        jobtest.collect_ids = lambda t_file: self.ids
+
+    def tearDown(self):
+        jobtest.collect_ids = self._collect_ids
+
+    def test_contiguous(self):
+        self.ids = ['test_a.py::T::test_%d' % idx for idx in range(10)]
+        chunks = jobtest.shards('test_a.py', 3)
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+        self.assertEqual(sum(chunks, []), self.ids)
+
+    def test_count(self):
+        self.ids = ['test_a.py::test_%d' % idx for idx in range(5)]
+        for count in range(1, 8):
+            chunks = jobtest.shards('test_a.py', count)
+            self.assertLessEqual(len(chunks), count)
+            self.assertTrue(all(chunks))
+            self.assertEqual(sum(chunks, []), self.ids)
+
+    def test_unsplittable(self):
+        self.assertIsNone(jobtest.shards('test_a.py', 4))
+        self.ids = []
+        self.assertIsNone(jobtest.shards('test_a.py', 4))
+        self.ids = ['test_a.py::test_one']
+        self.assertIsNone(jobtest.shards('test_a.py', 4))
+
+
+class AffectedFilesTC(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_affected(self):
+        t_files = [
+            self.write('test_parser.py', 'import os\n'),
+            self.write('test_single.py', 'from pkg import lexer, util\n'),
+            self.write('test_multi.py', 'from pkg import (\n'
+                                        '    util,\n'
+                                        '    lexer,\n'
+                                        ')\n'),
+            self.write('test_backslash.py', 'from pkg import util, \\\n'
+                                            '    lexer\n'),
+            self.write('test_other.py', 'from pkg import (\n'
+                                        '    util)\n'
+                                        'lexer = None\n'),
+        ]
+        affected = jobtest.affected_files(
+            t_files, ['pkg/lexer.py', 'pkg/parser.py'])
+        self.assertEqual(sorted(os.path.basename(path) for path in affected),
+                         ['test_backslash.py', 'test_multi.py',
+                          'test_parser.py', 'test_single.py'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8
+"""Tests of the journal of operations queued while offline"""
+
+import shutil
+import tempfile
+import unittest
+
+from cwclientlib.cwproxy import RemoteValidationError
+from mercurial import vfs as vfsmod
+from requests import ConnectionError
+
+from hgext.jpl.offline import Journal, replay
+
+
+class FakeUI(object):
+
+    def __init__(self):
+        self.warnings = []
+        self.messages = []
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+    def status(self, msg):
+        self.messages.append(msg)
+
+
+class FakeClient(object):
+    """Client replying to rqlio batches with given replies, in order; a reply
+    being an exception is raised"""
+    chunksize = 2
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.sent = []
+
+    def rqlio(self, queries, readonly=False):
+        self.sent.append(queries)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+class JournalTC(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = Journal(vfsmod.vfs(self.tmpdir))
+        self.ui = FakeUI()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_append_clear(self):
+        self.assertEqual(self.journal.read(), [])
+        self.journal.append('assign', ['a1', 'b2'], 'alice')
+        self.journal.append('add-reviewer', ['c3'], 'bob')
+        self.assertEqual([e['op'] for e in self.journal.read()],
+                         ['assign', 'add-reviewer'])
+        self.journal.clear()
+        self.assertEqual(self.journal.read(), [])
+
+    def test_replay_all(self):
+        self.journal.append('assign', ['a1', 'b2', 'c3'], 'alice')
+        self.journal.append('add-reviewer', ['c3'], 'bob')
+        client = FakeClient([[], []], [[]])
+        self.assertTrue(replay(self.ui, client, self.journal))
+        # one batch per entry, one query per chunk
+        self.assertEqual([len(queries) for queries in client.sent], [2, 1])
+        self.assertEqual(self.journal.read(), [])
+        self.assertEqual(self.ui.warnings, [])
+
+    def test_replay_drop_rejected(self):
+        self.journal.append('assign', ['a1'], 'nobody')
+        self.journal.append('add-reviewer', ['c3'], 'bob')
+        client = FakeClient(RemoteValidationError('unknown login'), [[]])
+        self.assertTrue(replay(self.ui, client, self.journal))
+        self.assertEqual(self.journal.read(), [])
+        self.assertEqual(len(self.ui.warnings), 1)
+        self.assertIn('unknown login', self.ui.warnings[0])
+
+    def test_replay_keep_unreachable(self):
+        self.journal.append('assign', ['a1'], 'alice')
+        self.journal.append('add-reviewer', ['c3'], 'bob')
+        client = FakeClient([[]], ConnectionError('refused'))
+        self.assertFalse(replay(self.ui, client, self.journal))
+        self.assertEqual(self.journal.read(),
+                         [{'op': 'add-reviewer', 'revs': ['c3'],
+                           'arg': 'bob'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8
+"""Tests of queries about many changesets, split in chunks"""
+
+import unittest
+
+from hgext.jpl.jplproxy import chunked_rql
+from hgext.jpl.review import add_reviewer, assign, assign_queries
+
+
+class FakeClient(object):
+    """Client answering write batches with one result set per query and
+    read queries with a row per changeset"""
+    chunksize = 2
+
+    def __init__(self, error=None):
+        self.error = error
+        self.batches = []
+        self.reads = []
+
+    def rqlio(self, queries, readonly=False):
+        self.batches.append(queries)
+        if self.error:
+            return self.error
+        return [[[idx]] for idx, query in enumerate(queries)]
+
+    def rql(self, rql, **kwargs):
+        self.reads.append((rql, kwargs))
+        revs = rql.split('(')[1].split(')')[0]
+        return [[rev.strip("'"), 'patch'] for rev in revs.split(',')]
+
+
+class ChunkedWritesTC(unittest.TestCase):
+
+    def test_queries(self):
+        queries = assign_queries(['a1', 'b2', 'c3'], 'alice', 2)
+        self.assertEqual(len(queries), 2)
+        self.assertIn("IN ('a1','b2')", queries[0][0])
+        self.assertIn("changeset 'c3'", queries[1][0])
+        self.assertIn("login 'alice'", queries[1][0])
+
+    def test_every_chunk(self):
+        client = FakeClient()
+        self.assertEqual(assign(client, ['a1', 'b2', 'c3', 'd4', 'e5'],
+                                'alice'),
+                         [[0], [1], [2]])
+        # chunks are sent in a single batch
+        self.assertEqual([len(queries) for queries in client.batches], [3])
+        self.assertEqual(add_reviewer(client, ['a1'], 'bob'), [[0]])
+
+    def test_error(self):
+        client = FakeClient(error='unknown login')
+        self.assertEqual(assign(client, ['a1', 'b2', 'c3'], 'nobody'),
+                         'unknown login')
+
+
+class ChunkedReadsTC(unittest.TestCase):
+
+    def test_rows(self):
+        client = FakeClient()
+        rows = chunked_rql(client, 'Any X WHERE X changeset IN ({revs})',
+                           ['a1', 'b2', 'c3', 'a1'])
+        # rows of every chunk, in chunk order, without duplicates
+        self.assertEqual(rows, [['a1', 'patch'], ['b2', 'patch'],
+                                ['c3', 'patch']])
+        self.assertEqual(len(client.reads), 2)
+        self.assertEqual(set(kwargs['vid'] for rql, kwargs in client.reads),
+                         set(['jsonexport']))
+
+    def test_no_revs(self):
+        self.assertEqual(chunked_rql(FakeClient(), '{revs}', []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()